@@ -1,15 +1,38 @@
+import time
+STARTUP_TIME = time.perf_counter()  # Отсчет времени до первого кадра
+
+import hashlib
+import json
+import logging
+import mmap
 import os
-import subprocess
+import shutil
+import struct
 import sys
-import requests
-from datetime import datetime, timedelta
-from PyQt5.QtGui import QPainterPath, QRegion, QMovie, QIcon, QColor, QFont, QPainter
+import tempfile
+import threading
+import weakref
+import zlib
+from bisect import bisect_right
+from math import ceil, floor
+from collections import OrderedDict
+from itertools import accumulate
+from PyQt5.QtGui import (QPainterPath, QIcon, QColor, QFont, QPainter, QImage, QImageReader, QPixmap, QGuiApplication, QWindow,
+                         QRegion)
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QLabel, QPushButton, QDialog, QVBoxLayout,
-                             QLineEdit, QDialogButtonBox, QWidget, QCheckBox, QDesktopWidget, QMessageBox,
-                             QSlider, QStyle, QStyleOptionSlider, QGraphicsOpacityEffect,)
+                             QLineEdit, QDialogButtonBox, QWidget, QCheckBox, QDesktopWidget, QMessageBox, QFileDialog,
+                             QSlider, QStyle, QStyleOptionSlider, QPlainTextEdit, QListView, QStyledItemDelegate,)
+
+from PyQt5.QtCore import (Qt, QProcess, QTimer, QPropertyAnimation, QSize, QPoint, QRect, QObject, QThread, pyqtSignal,
+                          QElapsedTimer, QEasingCurve, QEvent, QFileSystemWatcher, QAbstractListModel, QModelIndex)
+from PyQt5.QtNetwork import QLocalServer, QLocalSocket
+from PyQt5 import sip
+try:
+    import winreg  # Импортируем модуль для работы с реестром Windows
+except ImportError:
+    winreg = None  # Не Windows: функции реестра просто сообщат об ошибке
 
-from PyQt5.QtCore import Qt, QProcess, QTimer, QPropertyAnimation, QSize, QPoint
-import winreg  # Импортируем модуль для работы с реестром Windows
+log = logging.getLogger('kiwi_widget')
 
 DOCUMENTS_DIR = os.path.join(os.path.expanduser("~"), "Documents", "Kiwi Widget")
 GIF_FOLDER = os.path.join(DOCUMENTS_DIR, 'gif_files')
@@ -18,7 +41,55 @@ AUTOSTART_FILE = os.path.join(DOCUMENTS_DIR, 'autostart_config.txt')
 LAST_GIF_FILE = os.path.join(DOCUMENTS_DIR, 'last_gif.txt')
 AVATAR_IMAGE_URL = "https://encrypted-tbn0.gstatic.com/images?q=tbn:ANd9GcRbQET0UQUR67fyXYDkGJ9gCMy81rZ-W-gmSwaZdIdoifMUuKMoRz8fV-fXXXKO17VfJ5k&usqp=CAU"
 AVATAR_IMAGE_PATH = os.path.join(DOCUMENTS_DIR, 'avatar.png')
+APP_DIR = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
+ICON_PATH = os.path.join(APP_DIR, 'images.ico')  # Иконка, которая идет вместе с программой
+STARTUP_BUDGET_MS = 500  # Допустимое время до первого кадра при автозапуске
 OPACITY_FILE = os.path.join(DOCUMENTS_DIR, 'opacity_value.txt')
+SETTINGS_FILE = os.path.join(DOCUMENTS_DIR, 'settings.json')
+METRICS_FILE = os.path.join(DOCUMENTS_DIR, 'metrics.json')
+METRICS_INTERVAL = 1000  # Как часто (мс) обновлять оверлей и файл метрик
+SETTINGS_VERSION = 2
+SETTINGS_FLUSH_DELAY = 500  # Задержка (мс) перед записью настроек на диск
+LIVE_RELOAD_DELAY = 300  # Сколько мс тишины ждать после изменения файлов снаружи, прежде чем применять
+RESIZE_ANIMATION_DURATION = 250  # Длительность анимации размера (мс), независимо от расстояния
+EXACT_RESIZE_DELAY = 200  # Сколько мс размер должен не меняться, чтобы пересчитать кадры точно
+MIPMAP_MIN_SIDE = 32  # Меньше этого уровни mipmap не строим
+BATCH_SCALE_MIN_PIXELS = 8 * 1024 * 1024  # С какого объема (пикселей во всех кадрах) масштабировать в несколько потоков
+BATCH_SCALE_CHUNK = 8  # Меньше кадров на поток не даем: иначе накладные расходы съедят выигрыш
+RESIZE_ANIMATION_INTERVAL = 16  # Шаг таймера анимации размера (мс), ~60 кадров в секунду
+CORNER_RADIUS = 20  # Радиус скругления углов виджета
+FRAME_CACHE_MAX_ENTRIES = 4  # Сколько размеров гифки держим в памяти одновременно
+DEFAULT_FRAME_DELAY = 100  # Задержка кадра (мс), если в GIF она не указана
+STREAM_DECODE_BUDGET_MB = 256  # Гифки, которые в декодированном виде больше этого, играются потоково
+STREAM_LOOKAHEAD = 12  # На сколько кадров вперед потоковый декодер опережает показ
+FRAME_MEMORY_BUDGET_MB = 512  # Общий потолок памяти под кадры всех виджетов процесса
+MIN_RENDER_SCALE = 0.25  # Ниже этого разрешение кадров при нехватке памяти не опускаем
+STREAM_RETRY_DELAY = 5  # Через сколько мс снова спросить кадр, если декодер не успел
+PARTIAL_REPAINT_MAX_AREA = 0.6  # Если кадр меняет больше этой доли окна, перерисовываем целиком
+FRAME_STORE_SUFFIX = '.kfr'  # Предекодированные кадры рядом с гифкой в библиотеке
+FRAME_STORE_MAX_BYTES = 32 * 1024 * 1024  # Больше — не сохраняем, гифка декодируется как обычно
+FRAME_STORE_QUOTA = 128 * 1024 * 1024  # Отдельный лимит на все .kfr, не входит в лимит гифок
+FRAME_STORE_LEVEL = 1  # Уровень zlib: быстрая распаковка важнее последних процентов размера
+OCCLUSION_CHECK_INTERVAL = 1000  # Как часто (мс) проверять полноэкранные окна поверх виджета (Windows)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Размер куска при потоковой загрузке GIF
+DOWNLOAD_TIMEOUT = (5, 30)  # Таймауты (соединение, чтение) в секундах
+HTTP_CACHE_FILE = os.path.join(DOCUMENTS_DIR, 'http_cache.json')  # ETag/Last-Modified скачанных ссылок
+HTTP_POOL_SIZE = 4  # Keep-alive соединений на хост в общей сессии
+HTTP_OFFLINE_RETRY = 60  # Сколько секунд после сетевой ошибки не спрашивать сервер о том, что уже есть
+GIF_LIBRARY_INDEX = os.path.join(GIF_FOLDER, 'library.json')
+GIF_LIBRARY_QUOTA = 500 * 1024 * 1024  # Лимит места под гифки по умолчанию (байты)
+GIF_LIBRARY_SAVE_DELAY = 2000  # Задержка (мс) перед записью индекса после показа гифки
+THUMBNAIL_FOLDER = os.path.join(GIF_FOLDER, 'thumbnails')  # Превью библиотеки: <sha256>.png
+THUMBNAIL_SIZE = 128  # Большая сторона превью (пиксели)
+IMPORT_JOURNAL = os.path.join(GIF_FOLDER, 'import_journal.json')  # Что уже импортировано, для докачки импорта
+IMPORT_SAVE_EVERY = 50  # Через сколько файлов сохранять индекс библиотеки и журнал импорта
+THUMBNAIL_MEMORY_ITEMS = 600  # Сколько превью держать в памяти галереи (остальные читаются с диска)
+THUMBNAIL_QUEUE_LIMIT = 200  # Незагруженные превью сверх этого (давно прокрученные) забываются
+HOVER_ANIMATION_DELAY = 250  # Через сколько мс наведения оживает гифка в галерее
+# Сервер команд для kiwi_ctl.py и повторного запуска; имя свое для каждого пользователя
+IPC_SERVER_NAME = 'kiwi-widget-' + hashlib.sha1(DOCUMENTS_DIR.encode('utf-8')).hexdigest()[:12]
+IPC_TIMEOUT = 500  # Сколько мс ждать ответа запущенного экземпляра
+IPC_MAX_COORDINATE = 16777215  # Предел размеров и координат из команд (QWIDGETSIZE_MAX)
 
 # Убедимся, что каталог существует
 os.makedirs(DOCUMENTS_DIR, exist_ok=True)
@@ -52,9 +123,9 @@ def create_autostart_windows():
     try:
         with winreg.OpenKey(winreg.HKEY_CURRENT_USER, autostart_key, 0, winreg.KEY_SET_VALUE) as key:
             winreg.SetValueEx(key, app_name, 0, winreg.REG_SZ, app_path)
-            print(f"Автозапуск {app_name} добавлен в реестр Windows.")
+            log.info("Автозапуск %s добавлен в реестр Windows.", app_name)
     except Exception as e:
-        print(f"Ошибка при добавлении автозапуска в реестр: {e}")
+        log.error("Ошибка при добавлении автозапуска в реестр: %s", e)
 
 def remove_autostart_windows():
     autostart_key = r"Software\Microsoft\Windows\CurrentVersion\Run"
@@ -63,25 +134,2300 @@ def remove_autostart_windows():
     try:
         with winreg.OpenKey(winreg.HKEY_CURRENT_USER, autostart_key, 0, winreg.KEY_SET_VALUE) as key:
             winreg.DeleteValue(key, app_name)
-            print(f"Автозапуск {app_name} удален из реестра Windows.")
+            log.info("Автозапуск %s удален из реестра Windows.", app_name)
     except FileNotFoundError:
-        print(f"Запись {app_name} не найдена в реестре.")
+        log.warning("Запись %s не найдена в реестре.", app_name)
     except Exception as e:
-        print(f"Ошибка при удалении автозапуска из реестра: {e}")
+        log.error("Ошибка при удалении автозапуска из реестра: %s", e)
+
+def autostart_exists():
+    if sys.platform != 'win32':
+        return os.path.exists(AUTOSTART_PATH)
+    try:
+        with winreg.OpenKey(winreg.HKEY_CURRENT_USER, r"Software\Microsoft\Windows\CurrentVersion\Run", 0,
+                            winreg.KEY_READ) as key:
+            winreg.QueryValueEx(key, "Kiwi Widget")
+            return True
+    except OSError:
+        return False
+
+def apply_autostart(enabled):
+    # Приводит запись автозапуска системы в соответствие с настройкой
+    if sys.platform == 'win32':
+        if enabled:
+            create_autostart_windows()
+        else:
+            remove_autostart_windows()
+    elif enabled:
+        create_autostart_file()
+    else:
+        remove_autostart_file()
 
 def download_avatar_image():
     if not os.path.exists(AVATAR_IMAGE_PATH):
         try:
-            response = requests.get(AVATAR_IMAGE_URL)
-            response.raise_for_status()  
+            response = http_client().get(AVATAR_IMAGE_URL)
+            response.raise_for_status()
             with open(AVATAR_IMAGE_PATH, 'wb') as f:
                 f.write(response.content)
-            print(f"Аватарка загружена и сохранена по пути: {AVATAR_IMAGE_PATH}")
+            log.info("Аватарка загружена и сохранена по пути: %s", AVATAR_IMAGE_PATH)
         except Exception as e:
-            print(f"Ошибка загрузки аватарки: {e}")
+            log.error("Ошибка загрузки аватарки: %s", e)
     return AVATAR_IMAGE_PATH
 
 
+DEFAULT_SETTINGS = {
+    'version': SETTINGS_VERSION,
+    'widgets': [],  # Настройки каждого виджета, см. WIDGET_DEFAULTS
+    'autostart': False,
+    'fps_cap': 0,  # Ограничение частоты кадров, 0 — без ограничения
+    'metrics_overlay': False,  # Показывать метрики поверх гифки
+    'metrics_dump': False,  # Писать метрики в METRICS_FILE
+    'decode_budget_mb': STREAM_DECODE_BUDGET_MB,
+    'stream_lookahead': STREAM_LOOKAHEAD,
+    'memory_budget_mb': FRAME_MEMORY_BUDGET_MB,
+}
+WIDGET_DEFAULTS = {
+    'geometry': None,  # [ширина, высота, x, y]
+    'opacity': None,
+    'last_gif': None,
+    'playlist': [],  # Файлы и ссылки для ротации
+    'playlist_interval': 0,  # Смена гифки каждые N секунд, 0 — только вручную
+    'playlist_index': 0,
+}
+
+
+def upgrade_settings(values):
+    # Версия 1 хранила один виджет прямо в корне настроек
+    if values.get('version', 1) < 2 or 'widgets' not in values:
+        values['widgets'] = [{key: values.pop(key, WIDGET_DEFAULTS[key]) for key in WIDGET_DEFAULTS}]
+    values['version'] = SETTINGS_VERSION
+    return values
+
+
+def read_legacy_settings():
+    # Настройки из старых отдельных файлов, до появления settings.json
+    values = {}
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            size_position = f.read().split()
+            if len(size_position) == 4:
+                values['geometry'] = list(map(int, size_position))
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(OPACITY_FILE, 'r') as f:
+            values['opacity'] = int(f.read().strip())
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(LAST_GIF_FILE, 'r') as f:
+            values['last_gif'] = f.read() or None
+    except OSError:
+        pass
+    try:
+        with open(AUTOSTART_FILE, 'r') as f:
+            values['autostart'] = f.read().strip().lower() in ('1', 'true', 'yes', 'on')
+    except OSError:
+        pass
+    return values
+
+
+# Старые файлы настроек -> ключ, который они задают; скрипты по-прежнему могут писать в них
+LEGACY_SETTINGS_KEYS = {
+    CONFIG_FILE: 'geometry',
+    OPACITY_FILE: 'opacity',
+    LAST_GIF_FILE: 'last_gif',
+    AUTOSTART_FILE: 'autostart',
+}
+
+
+class SettingsStore(QObject):
+    # Все настройки в одном файле: читаем один раз при старте, изменения копим
+    # в памяти и пишем на диск с задержкой через временный файл
+    externalChanged = pyqtSignal(object)  # Результат external_changes(), найденный при записи
+
+    def __init__(self, path=SETTINGS_FILE, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.values = dict(DEFAULT_SETTINGS, widgets=[])
+        self._disk = {}  # Файл, каким мы его последний раз прочитали или записали
+        self._stamp = None  # mtime и размер файла на тот момент
+        self._dirty = False
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(SETTINGS_FLUSH_DELAY)
+        self._flush_timer.timeout.connect(self.flush)
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            legacy = read_legacy_settings()
+            # Старые версии не писали autostart_config.txt: берем то, что есть в системе
+            legacy.setdefault('autostart', autostart_exists())
+            self.values.update(upgrade_settings(legacy))
+            self._dirty = True
+            self.flush()
+            log.info("Настройки перенесены в %s", self.path)
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.values.update(upgrade_settings(json.load(f)))
+        except (OSError, ValueError) as e:
+            log.error("Ошибка чтения настроек: %s", e)
+        self._disk = json.loads(json.dumps(self.values))
+        self._stamp = self._disk_stamp()
+
+    def _disk_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def external_changes(self):
+        # Что поменяли в файле снаружи с нашего последнего чтения или записи. Изменения
+        # сразу попадают в values, несохраненные свои правки остальных ключей сохраняются.
+        # Возвращает (ключи корня, [(значения виджета, ключи)]); виджеты None, если их
+        # добавили или удалили — тогда values целиком берутся из файла
+        self._stamp = self._disk_stamp()  # До чтения: запись после него заметим в следующий раз
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                disk = upgrade_settings(json.load(f))
+        except (OSError, ValueError) as e:
+            log.error("Ошибка чтения настроек: %s", e)
+            return None
+        previous, self._disk = self._disk, json.loads(json.dumps(disk))
+        root = {key for key in disk if key != 'widgets' and disk[key] != previous.get(key)}
+        for key in root:
+            self.values[key] = disk[key]
+        old_widgets, new_widgets = previous.get('widgets', []), disk['widgets']
+        if len(old_widgets) != len(new_widgets) or len(new_widgets) != len(self.values['widgets']):
+            self.values = dict(DEFAULT_SETTINGS, **disk)
+            self._dirty = False
+            return root, None
+        widgets = []
+        for values, old, new in zip(self.values['widgets'], old_widgets, new_widgets):
+            keys = {key for key in WIDGET_DEFAULTS if new.get(key) != old.get(key)}
+            for key in keys:
+                values[key] = new.get(key)
+            if keys:
+                widgets.append((values, keys))
+        return root, widgets
+
+    def reload(self):
+        self.values = dict(DEFAULT_SETTINGS, widgets=[])
+        self.load()
+
+    def get(self, key):
+        return self.values.get(key, DEFAULT_SETTINGS.get(key))
+
+    def set(self, key, value):
+        if self.values.get(key) == value:
+            return
+        self.values[key] = value
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        self._dirty = True
+        self._flush_timer.start()  # Каждое изменение откладывает запись
+
+    def widget_settings(self, index):
+        widgets = self.values['widgets']
+        while len(widgets) <= index:
+            widgets.append(dict(WIDGET_DEFAULTS))
+        return WidgetSettings(self, widgets[index])
+
+    def add_widget(self, values=None):
+        widget = dict(WIDGET_DEFAULTS, **(values or {}))
+        self.values['widgets'].append(widget)
+        self.mark_dirty()
+        return WidgetSettings(self, widget)
+
+    def remove_widget(self, widget_settings):
+        widgets = self.values['widgets']
+        self.values['widgets'] = [widget for widget in widgets if widget is not widget_settings.values]
+        self.mark_dirty()
+
+    def flush(self):
+        self._flush_timer.stop()
+        if not self._dirty:
+            return
+        stamp = self._disk_stamp()
+        if stamp is not None and stamp != self._stamp:
+            # Файл изменили снаружи, пока наша запись ждала таймера: сначала забираем
+            # чужие правки (их применяет менеджер), потом пишем поверх свои
+            changes = self.external_changes()
+            if changes is not None:
+                self.externalChanged.emit(changes)
+            if not self._dirty:
+                return
+        tmp_path = self.path + '.tmp'
+        try:
+            text = json.dumps(self.values, ensure_ascii=False, indent=1)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, self.path)
+            self._disk = json.loads(text)
+            self._stamp = self._disk_stamp()
+            self._dirty = False
+        except OSError as e:
+            log.error("Ошибка сохранения настроек: %s", e)
+
+
+class WidgetSettings:
+    # Настройки одного виджета внутри общего SettingsStore; общие ключи
+    # (автозапуск, FPS, метрики) читаются и пишутся в корень настроек
+    def __init__(self, store, values):
+        self.store = store
+        self.values = values
+
+    def get(self, key):
+        if key in WIDGET_DEFAULTS:
+            return self.values.get(key)
+        return self.store.get(key)
+
+    def set(self, key, value):
+        if key not in WIDGET_DEFAULTS:
+            self.store.set(key, value)
+        elif self.values.get(key) != value:
+            self.values[key] = value
+            self.store.mark_dirty()
+
+    def flush(self):
+        self.store.flush()
+
+
+def current_rss_kb():
+    # Текущий объем памяти процесса в КБ
+    if sys.platform.startswith('linux'):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                    'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                 ctypes.byref(counters), counters.cb)
+        return counters.WorkingSetSize // 1024
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024  # macOS: пиковое значение
+
+
+class PerformanceMetrics:
+    # Счетчики стоимости виджета; пока метрики выключены, горячие пути их не трогают
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.dropped_frames = 0
+        self.decode_ms = 0.0
+        self.blit_ms = 0.0
+        self.blits = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.started = time.perf_counter()
+
+    def snapshot(self):
+        # Значения за период с прошлого снимка
+        elapsed = max(time.perf_counter() - self.started, 1e-6)
+        lookups = self.cache_hits + self.cache_misses
+        values = {
+            'fps': self.frames / elapsed,
+            'dropped_frames': self.dropped_frames,
+            'decode_ms': self.decode_ms,
+            'blit_ms': self.blit_ms / self.blits if self.blits else 0.0,
+            'cache_hit_rate': self.cache_hits / lookups if lookups else None,
+            'rss_kb': current_rss_kb(),
+        }
+        self.reset()
+        return values
+
+
+metrics = PerformanceMetrics()
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+IMAGE_SUFFIXES = {'gif': '.gif', 'webp': '.webp', 'apng': '.png', 'png': '.png'}
+
+
+def sniff_image_format(path):
+    # Формат по сигнатуре содержимого, а не по расширению ссылки или файла:
+    # 'gif', 'webp', 'apng', 'png' (без анимации) или None
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(16)
+            if head[:6] in (b'GIF87a', b'GIF89a'):
+                return 'gif'
+            if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+                return 'webp'
+            if head[:8] != PNG_SIGNATURE:
+                return None
+            # APNG отличается чанком acTL, который обязан идти до первого IDAT
+            f.seek(8)
+            while True:
+                chunk = f.read(8)
+                if len(chunk) < 8 or chunk[4:] in (b'IDAT', b'IEND'):
+                    return 'png'
+                if chunk[4:] == b'acTL':
+                    return 'apng'
+                f.seek(struct.unpack('>I', chunk[:4])[0] + 4, os.SEEK_CUR)
+    except OSError:
+        return None
+
+
+def png_chunk(kind, body):
+    return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+
+
+def decode_apng_frames(path):
+    # Qt читает у APNG только первый кадр, поэтому каждый кадр собираем в отдельный
+    # PNG (IHDR с размером кадра, общие чанки, данные из fdAT), декодируем через Qt
+    # и накладываем на холст по правилам dispose/blend из fcTL
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    ihdr = None
+    shared = []  # PLTE, tRNS, цветовые чанки — общие для всех кадров
+    frames = []  # [fcTL, [сжатые данные]]
+    pos = len(PNG_SIGNATURE)
+    try:
+        while pos + 8 <= len(data):
+            length, kind = struct.unpack_from('>I4s', data, pos)
+            body = data[pos + 8:pos + 8 + length]
+            pos += length + 12
+            if kind == b'IHDR':
+                ihdr = body
+            elif kind == b'fcTL':
+                frames.append([struct.unpack('>IIIIIHHBB', body[:26]), []])
+            elif kind == b'IDAT':
+                if frames:  # IDAT без fcTL — картинка-заглушка, в анимацию не входит
+                    frames[-1][1].append(body)
+            elif kind == b'fdAT':
+                if frames:
+                    frames[-1][1].append(body[4:])
+            elif kind == b'IEND':
+                break
+            elif not frames and kind not in (b'acTL', b'tEXt', b'zTXt', b'iTXt'):
+                shared.append(png_chunk(kind, body))
+    except struct.error:
+        pass  # Обрезанный файл: играем то, что успели прочитать
+    frames = [frame for frame in frames if frame[1]]
+    if ihdr is None or not frames:
+        return None
+    width, height = struct.unpack('>II', ihdr[:8])
+    canvas = QImage(width, height, QImage.Format_ARGB32)
+    canvas.fill(Qt.transparent)
+    images = []
+    delays = []
+    for index, ((_, w, h, x, y, delay_num, delay_den, dispose, blend), chunks) in enumerate(frames):
+        png = b''.join([PNG_SIGNATURE, png_chunk(b'IHDR', struct.pack('>II', w, h) + ihdr[8:]), *shared,
+                        png_chunk(b'IDAT', b''.join(chunks)), png_chunk(b'IEND', b'')])
+        image = QImage.fromData(png, 'PNG')
+        if image.isNull() or x + w > width or y + h > height:
+            break
+        if dispose == 2 and index == 0:
+            dispose = 1  # APNG: "вернуть предыдущее" у первого кадра значит очистить
+        previous = canvas.copy(x, y, w, h) if dispose == 2 else None
+        painter = QPainter(canvas)
+        painter.setCompositionMode(QPainter.CompositionMode_Source if blend == 0
+                                   else QPainter.CompositionMode_SourceOver)
+        painter.drawImage(x, y, image)
+        painter.end()
+        images.append(canvas.copy())
+        delay = delay_num * 1000 // (delay_den or 100)
+        delays.append(delay if delay > 0 else DEFAULT_FRAME_DELAY)
+        if dispose:
+            painter = QPainter(canvas)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            if previous is None:
+                painter.fillRect(x, y, w, h, Qt.transparent)
+            else:
+                painter.drawImage(x, y, previous)
+            painter.end()
+    if not images:
+        return None
+    return images, delays
+
+
+def decode_gif_frames(gif_path):
+    # Декодируем все кадры один раз, вместе с задержками. Формат определяется по
+    # содержимому: GIF и WebP читает Qt, APNG — decode_apng_frames
+    image_format = sniff_image_format(gif_path)
+    if image_format == 'apng':
+        return decode_apng_frames(gif_path)
+    reader = QImageReader(gif_path, image_format.encode()) if image_format else QImageReader(gif_path)
+    if not reader.canRead():
+        return None
+    images = []
+    delays = []
+    while True:
+        image = reader.read()
+        if image.isNull():
+            break
+        delay = reader.nextImageDelay()
+        images.append(image)
+        delays.append(delay if delay > 0 else DEFAULT_FRAME_DELAY)
+        if not reader.canRead():
+            break
+    if not images:
+        return None
+    return images, delays
+
+
+# Формат .kfr: заголовок, таблица кадров и данные. Каждый кадр — только
+# прямоугольник, изменившийся относительно предыдущего: 8-битные индексы с палитрой
+# или, если цветов больше 256, ARGB32, сжатые zlib. Строки выровнены по 4 байта,
+# чтобы распакованные данные сразу подходили для QImage
+FRAME_STORE_MAGIC = b'KIWIFRM2'
+FRAME_STORE_HEADER = struct.Struct('<8sqqIIII')  # магия, размер и mtime исходника, ширина, высота, кадров, crc таблицы
+FRAME_STORE_ENTRY = struct.Struct('<IHHHHBxHQI')  # задержка, x, y, ширина, высота, формат, цветов, смещение, длина
+FRAME_STORE_INDEXED = 0
+FRAME_STORE_ARGB32 = 1
+
+
+def frame_store_path(gif_path):
+    return os.path.splitext(gif_path)[0] + FRAME_STORE_SUFFIX
+
+
+def in_gif_folder(path):
+    # .kfr бывают только у гифок библиотеки: рядом с чужими файлами ничего не читаем и не удаляем
+    folder = os.path.normcase(os.path.abspath(GIF_FOLDER))
+    return os.path.normcase(os.path.dirname(os.path.abspath(path))) == folder
+
+
+def image_bytes(image):
+    return image.constBits().asstring(image.sizeInBytes())
+
+
+def changed_rect(previous, current, width, height):
+    # Прямоугольник отличающихся пикселей двух кадров ARGB32 (x, y, ширина, высота)
+    row_bytes = width * 4
+    rows = [y for y in range(height)
+            if previous[y * row_bytes:(y + 1) * row_bytes] != current[y * row_bytes:(y + 1) * row_bytes]]
+    if not rows:
+        return 0, 0, 0, 0
+    left, right = row_bytes, 0
+    for y in range(rows[0], rows[-1] + 1):
+        # XOR строк как больших чисел: первый и последний отличающийся байт без цикла по пикселям
+        diff = (int.from_bytes(previous[y * row_bytes:(y + 1) * row_bytes], 'big')
+                ^ int.from_bytes(current[y * row_bytes:(y + 1) * row_bytes], 'big'))
+        if diff:
+            left = min(left, row_bytes - (diff.bit_length() + 7) // 8)
+            right = max(right, row_bytes - 1 - ((diff & -diff).bit_length() - 1) // 8)
+    left //= 4
+    right //= 4
+    return left, rows[0], right - left + 1, rows[-1] - rows[0] + 1
+
+
+def write_frame_store(gif_path, images=None, delays=None):
+    # Перекодирует гифку в .kfr; возвращает размер файла или None, если не сохранили
+    try:
+        stat = os.stat(gif_path)
+    except OSError:
+        return None
+    if images is None:
+        decoded = decode_gif_frames(gif_path)
+        if decoded is None:
+            return None
+        images, delays = decoded
+    width, height = images[0].width(), images[0].height()
+    table = []
+    chunks = []
+    offset = FRAME_STORE_HEADER.size + FRAME_STORE_ENTRY.size * len(images)
+    previous = None
+    for image, delay in zip(images, delays):
+        image = image.convertToFormat(QImage.Format_ARGB32)
+        if image.width() != width or image.height() != height:
+            return None
+        current = image_bytes(image)
+        if previous is None:
+            x, y, w, h = 0, 0, width, height
+        else:
+            x, y, w, h = changed_rect(previous, current, width, height)
+        previous = current
+        fmt, colors, data = FRAME_STORE_INDEXED, 0, b''
+        if w and h:
+            rect = image.copy(x, y, w, h)
+            indexed = rect.convertToFormat(QImage.Format_Indexed8, Qt.ThresholdDither | Qt.AvoidDither)
+            if indexed.convertToFormat(QImage.Format_ARGB32) == rect:
+                colors = indexed.colorCount()
+                stride = (w + 3) & ~3
+                palette = struct.pack(f'<{colors}I', *indexed.colorTable())
+                pixels = indexed
+            else:
+                fmt, stride, palette, pixels = FRAME_STORE_ARGB32, w * 4, b'', rect
+            raw = image_bytes(pixels)
+            line = pixels.bytesPerLine()
+            data = zlib.compress(palette + b''.join(raw[row * line:row * line + stride] for row in range(h)),
+                                 FRAME_STORE_LEVEL)
+        table.append(FRAME_STORE_ENTRY.pack(delay, x, y, w, h, fmt, colors, offset, len(data)))
+        chunks.append(data)
+        offset += len(data)
+        if offset > FRAME_STORE_MAX_BYTES:
+            log.info("Кадры %s слишком большие для %s", gif_path, FRAME_STORE_SUFFIX)
+            return None
+    table = b''.join(table)
+    header = FRAME_STORE_HEADER.pack(FRAME_STORE_MAGIC, stat.st_size, stat.st_mtime_ns,
+                                     width, height, len(images), zlib.crc32(table))
+    store_path = frame_store_path(gif_path)
+    tmp_path = store_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(table)
+            for data in chunks:
+                f.write(data)
+        os.replace(tmp_path, store_path)
+    except OSError as e:
+        log.error("Ошибка записи %s: %s", store_path, e)
+        return None
+    return offset
+
+
+def read_frame_store(gif_path):
+    # Кадры из .kfr: без разбора GIF и LZW, только распаковка zlib и наложение
+    # прямоугольников. Кадры собираются в собственные QImage процесса, файл после
+    # чтения не нужен. Устаревший (исходник изменился) или поврежденный файл
+    # удаляется, и гифка декодируется как обычно. Файл с чужой магией не наш — его не трогаем
+    store_path = frame_store_path(gif_path)
+    try:
+        stat = os.stat(gif_path)
+        with open(store_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, size, mtime_ns, width, height, count, crc = FRAME_STORE_HEADER.unpack_from(data)
+            if magic != FRAME_STORE_MAGIC:
+                log.warning("Кэш кадров %s не используется: неизвестный формат", store_path)
+                return None
+            if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                raise ValueError("исходник изменился")
+            table_end = FRAME_STORE_HEADER.size + FRAME_STORE_ENTRY.size * count
+            if not count or table_end > len(data) or zlib.crc32(data[FRAME_STORE_HEADER.size:table_end]) != crc:
+                raise ValueError("таблица кадров повреждена")
+            images, delays = [], []
+            canvas = QImage(width, height, QImage.Format_ARGB32)
+            canvas.fill(Qt.transparent)
+            painter = QPainter(canvas)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            try:
+                for i in range(count):
+                    delay, x, y, w, h, fmt, colors, offset, length = FRAME_STORE_ENTRY.unpack_from(
+                        data, FRAME_STORE_HEADER.size + FRAME_STORE_ENTRY.size * i)
+                    if w and h:
+                        if x + w > width or y + h > height:
+                            raise ValueError("кадр за пределами холста")
+                        if offset + length > len(data):
+                            raise ValueError("данные кадра обрезаны")
+                        pixels = zlib.decompress(data[offset:offset + length])
+                        start = 0
+                        if fmt == FRAME_STORE_INDEXED:
+                            stride = (w + 3) & ~3
+                            palette = struct.unpack_from(f'<{colors}I', pixels)
+                            start = colors * 4
+                        else:
+                            stride = w * 4
+                        if start + stride * h != len(pixels):
+                            raise ValueError("данные кадра обрезаны")
+                        frame = QImage(pixels[start:], w, h, stride,
+                                       QImage.Format_Indexed8 if fmt == FRAME_STORE_INDEXED else QImage.Format_ARGB32)
+                        if fmt == FRAME_STORE_INDEXED:
+                            frame.setColorTable(palette)
+                        painter.drawImage(x, y, frame)
+                        del frame
+                    painter.end()
+                    images.append(QImage(canvas))  # Копия при записи: следующий кадр рисуется в новый буфер
+                    delays.append(delay)
+                    painter.begin(canvas)
+                    painter.setCompositionMode(QPainter.CompositionMode_Source)
+            finally:
+                if painter.isActive():
+                    painter.end()
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error, zlib.error) as e:
+        log.warning("Кэш кадров %s не используется: %s", store_path, e)
+        try:
+            os.remove(store_path)
+        except OSError:
+            pass
+        return None
+    return images, delays
+
+
+def scan_gif_frames(gif_path):
+    # Проходит по блокам GIF без декодирования: размер холста, задержки всех кадров
+    # и область, которую меняет каждый кадр. Нужен, чтобы оценить память до
+    # декодирования, знать длину цикла в потоковом режиме и перерисовывать не все окно
+    try:
+        with open(gif_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:3] != b'GIF' or len(data) < 13:
+                return None
+            width = int.from_bytes(data[6:8], 'little')
+            height = int.from_bytes(data[8:10], 'little')
+            pos = 13
+            if data[10] & 0x80:
+                pos += 3 << ((data[10] & 0x07) + 1)  # Глобальная палитра
+            delays = []
+            rects = []  # (x, y, ширина, высота) измененной области холста
+            delay = 0
+            disposal = 0
+            cleared = None  # Область, которую предыдущий кадр очищает или восстанавливает
+
+            def skip_sub_blocks(pos):
+                while data[pos]:
+                    pos += data[pos] + 1
+                return pos + 1
+
+            while pos < len(data):
+                block = data[pos]
+                if block == 0x21:  # Расширение
+                    if data[pos + 1] == 0xF9 and data[pos + 2] >= 4:
+                        disposal = (data[pos + 3] >> 2) & 0x07
+                        delay = int.from_bytes(data[pos + 4:pos + 6], 'little') * 10
+                    pos = skip_sub_blocks(pos + 2)
+                elif block == 0x2C:  # Кадр
+                    rect = struct.unpack_from('<HHHH', data, pos + 1)
+                    flags = data[pos + 9]
+                    pos += 10
+                    if flags & 0x80:
+                        pos += 3 << ((flags & 0x07) + 1)  # Локальная палитра
+                    pos = skip_sub_blocks(pos + 1)
+                    delays.append(delay if delay > 0 else DEFAULT_FRAME_DELAY)
+                    if cleared is None:
+                        rects.append(rect)
+                    else:
+                        left, top = min(rect[0], cleared[0]), min(rect[1], cleared[1])
+                        right = max(rect[0] + rect[2], cleared[0] + cleared[2])
+                        bottom = max(rect[1] + rect[3], cleared[1] + cleared[3])
+                        rects.append((left, top, right - left, bottom - top))
+                    cleared = rect if disposal in (2, 3) else None
+                    delay = 0
+                    disposal = 0
+                else:
+                    break  # 0x3B — конец файла, остальное — мусор после него
+    except (OSError, ValueError, IndexError):
+        return None
+    if not delays:
+        return None
+    return width, height, delays, rects
+
+
+def scale_rect(rect, source_size, size):
+    # Область исходного кадра в координатах отмасштабированного; запас на сглаживание
+    # при масштабировании. None — проще перерисовать весь кадр
+    sx = size.width() / source_size.width()
+    sy = size.height() / source_size.height()
+    pad = ceil(max(sx, sy)) + 1
+    left, top = floor(rect.x() * sx) - pad, floor(rect.y() * sy) - pad
+    right, bottom = ceil(rect.right() * sx) + pad, ceil(rect.bottom() * sy) + pad
+    scaled = QRect(left, top, right - left + 1, bottom - top + 1).intersected(QRect(QPoint(0, 0), size))
+    if scaled.width() * scaled.height() > PARTIAL_REPAINT_MAX_AREA * size.width() * size.height():
+        return None
+    return scaled
+
+
+class StreamingFrames:
+    # Потоковое декодирование больших GIF: в памяти только кольцевой буфер кадров
+    # впереди текущего, фоновый поток держится на lookahead кадров впереди показа.
+    # Кадры нумеруются сквозь циклы (цикл * число кадров + кадр), чтобы отличать
+    # отставание декодера от опережения
+    def __init__(self, gif_path, size, delays, lookahead=STREAM_LOOKAHEAD):
+        self.gif_path = gif_path
+        self.size = QSize(size)
+        self.count = len(delays)
+        self.lookahead = max(int(lookahead), 1)
+        self.frames = {}  # Номер кадра -> QImage нужного размера
+        self.playhead = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def frame(self, number, timeout=None):
+        # Кадр для показа или None, если декодер еще не успел; старые кадры отпускаем
+        with self.condition:
+            if number != self.playhead:
+                self.playhead = number
+                for old in [key for key in self.frames if key < number]:
+                    del self.frames[old]
+                self.condition.notify_all()
+            if timeout:
+                self.condition.wait_for(lambda: number in self.frames or self.closed, timeout)
+            return self.frames.get(number)
+
+    def memory_bytes(self):
+        with self.condition:
+            return sum(image.sizeInBytes() for image in self.frames.values())
+
+    def set_size(self, size):
+        # Уже готовые кадры старого размера дотягивает проигрыватель, новые декодируются сразу в новом
+        with self.condition:
+            self.size = QSize(size)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.frames.clear()
+            self.condition.notify_all()
+
+    def _run(self):
+        reader = None
+        position = self.playhead - self.playhead % self.count
+        while True:
+            with self.condition:
+                while not self.closed and position > self.playhead + self.lookahead:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                if self.playhead - position >= self.count:
+                    # Отстали больше чем на цикл (например, после паузы): сразу к началу нужного цикла
+                    position = self.playhead - self.playhead % self.count
+                    reader = None
+                skip = position < self.playhead
+                size = self.size
+            if reader is None or position % self.count == 0:
+                reader = QImageReader(self.gif_path)
+            started = time.perf_counter()
+            image = reader.read()
+            if image.isNull():
+                if position % self.count == 0:
+                    log.error("Не удалось декодировать %s: %s", self.gif_path, reader.errorString())
+                    self.close()
+                    return
+                # Кадров меньше, чем в заголовках: добиваем цикл пустыми кадрами не декодируя
+                position += self.count - position % self.count
+                reader = None
+                continue
+            if not skip:
+                # Отстающие кадры декодируем только ради композиции следующих, без масштабирования
+                image = on_white(image.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+                with self.condition:
+                    if self.closed:
+                        return
+                    self.frames[position] = image
+                    self.condition.notify_all()
+            if metrics.enabled:
+                metrics.decode_ms += (time.perf_counter() - started) * 1000
+            position += 1
+
+
+def decode_source(gif_path):
+    # Исходные кадры: из .kfr, если библиотека его подготовила, иначе декодированием самого файла
+    if in_gif_folder(gif_path):
+        decoded = read_frame_store(gif_path)
+        if decoded is not None:
+            return decoded
+    return decode_gif_frames(gif_path)
+
+
+_scale_pool = None
+_scale_pool_lock = threading.Lock()
+
+
+def scale_pool():
+    global _scale_pool
+    with _scale_pool_lock:
+        if _scale_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _scale_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='kiwi-scale')
+        return _scale_pool
+
+
+def on_white(image):
+    # Кадр на белой подложке окна, без альфа-канала. Подложка и кадр становятся одним
+    # слоем один раз при масштабировании, и прозрачность виджета — это один drawPixmap
+    if not image.hasAlphaChannel():
+        return image
+    flat = QImage(image.size(), QImage.Format_RGB32)
+    flat.setDevicePixelRatio(image.devicePixelRatio())
+    flat.fill(Qt.white)
+    painter = QPainter(flat)
+    painter.drawImage(0, 0, image)
+    painter.end()
+    return flat
+
+
+def scale_frames(images, size):
+    # Все кадры под новый размер, сразу на белой подложке. PyQt отпускает GIL на время
+    # QImage.scaled, поэтому большие гифки делятся по диапазонам кадров между потоками
+    # пула и считаются на всех ядрах, а кадры не копируются между процессами
+    source_size = images[0].size()
+    workers = min(os.cpu_count() or 1, len(images) // BATCH_SCALE_CHUNK)
+    if workers < 2 or len(images) * source_size.width() * source_size.height() < BATCH_SCALE_MIN_PIXELS:
+        return [on_white(image.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)) for image in images]
+
+    def scale_range(start, stop):
+        return [on_white(image.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)) for image in images[start:stop]]
+
+    bounds = [len(images) * part // workers for part in range(workers + 1)]
+    futures = [scale_pool().submit(scale_range, start, stop) for start, stop in zip(bounds, bounds[1:])]
+    return [image for future in futures for image in future.result()]
+
+
+def mipmap_half(level, size):
+    # Размер следующего уровня mipmap или None, если он получится меньше size
+    half = QSize(level[0].width() // 2, level[0].height() // 2)
+    if min(half.width(), half.height()) < MIPMAP_MIN_SIDE or half.width() < size.width() or half.height() < size.height():
+        return None
+    return half
+
+
+def mipmap_levels(level, size):
+    # Для пула: уровни вдвое меньше предыдущего, пока не меньше size, сразу на белой подложке
+    levels = []
+    half = mipmap_half(level, size)
+    while half is not None:
+        level = [on_white(image.scaled(half, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)) for image in level]
+        levels.append(level)
+        half = mipmap_half(level, size)
+    return levels
+
+
+class FrameCache:
+    # Кэш готовых к отрисовке кадров: один раз декодируем GIF и один раз
+    # масштабируем под каждый размер окна, дальше только blit
+    # Один кэш на процесс: одинаковые GIF одного размера в разных окнах делят кадры.
+    # Слишком большие гифки не кэшируются целиком, а играются потоково (StreamingFrames).
+    # Все кадры вместе укладываются в memory_budget; когда не влезают, кэш по очереди
+    # вытесняет неиспользуемые размеры, переходит на потоковое декодирование
+    # и, если гифку нельзя играть потоково, понижает разрешение кадров
+    def __init__(self, max_entries=FRAME_CACHE_MAX_ENTRIES, decode_budget_mb=STREAM_DECODE_BUDGET_MB,
+                 lookahead=STREAM_LOOKAHEAD, memory_budget_mb=FRAME_MEMORY_BUDGET_MB):
+        self.max_entries = max_entries
+        self.decode_budget = decode_budget_mb * 1024 * 1024
+        self.lookahead = lookahead
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._sources = OrderedDict()  # (путь, mtime) -> (исходные кадры, задержки)
+        self._scaled = OrderedDict()  # (путь, mtime, ширина, высота) -> (pixmap'ы, задержки, области)
+        self._scans = {}  # (путь, mtime) -> результат scan_gif_frames
+        self._rects = {}  # (путь, mtime) -> измененная область каждого кадра, см. _source_rects
+        self._user_keys = {}  # Проигрыватель -> ключ кадров, которые он сейчас показывает
+        self._streams = {}  # Проигрыватель -> его потоковый декодер
+        self._scaled_bytes = {}  # Ключ _scaled -> сколько занимают его кадры
+        self._reduced = set()  # Ключи _scaled, кадры которых в пониженном разрешении
+        self._tiers = {}  # (путь, mtime) -> уменьшенные вдвое, вчетверо... копии исходных кадров
+        self._tier_jobs = {}  # (путь, mtime) -> Future из scale_pool со следующими уровнями
+
+    def _source_key(self, gif_path):
+        try:
+            mtime = os.path.getmtime(gif_path)
+        except OSError:
+            return None
+        return gif_path, mtime
+
+    def _get_source(self, key):
+        if key in self._sources:
+            self._sources.move_to_end(key)
+            return self._sources[key]
+        decoded = decode_source(key[0])
+        if decoded is None:
+            return None
+        self._add_source(key, decoded)
+        return decoded
+
+    def _scan(self, key):
+        if key not in self._scans:
+            self._scans[key] = scan_gif_frames(key[0])
+        return self._scans[key]
+
+    def _source_rects(self, key, images):
+        # Что меняет каждый кадр относительно предыдущего: QRect в координатах GIF,
+        # пустой QRect — кадр совпадает с предыдущим, None — перерисовать целиком.
+        # Первый кадр идет после последнего, поэтому всегда целиком
+        if key in self._rects:
+            return self._rects[key]
+        scan = self._scan(key)
+        rects = None
+        if scan is not None and len(scan[3]) == len(images):
+            canvas = QRect(0, 0, images[0].width(), images[0].height())
+            rects = [None]
+            for index in range(1, len(images)):
+                if images[index] == images[index - 1]:
+                    rects.append(QRect())
+                else:
+                    rects.append(QRect(*scan[3][index]).intersected(canvas))
+        self._rects[key] = rects
+        return rects
+
+    def _scaled_rects(self, key, images, size):
+        rects = self._source_rects(key, images)
+        if rects is None:
+            return None
+        source_size = images[0].size()
+        return [rect if rect is None or rect.isEmpty() else scale_rect(rect, source_size, size) for rect in rects]
+
+    def _sources_bytes(self):
+        # Вместе с уровнями mipmap: они живут и вытесняются вместе со своим исходником
+        levels = [images for images, _ in list(self._sources.values())]
+        levels += [images for tier in list(self._tiers.values()) for images in tier]
+        return sum(image.sizeInBytes() for images in levels for image in images)
+
+    def _forget_tiers(self):
+        for key in list(self._tiers):
+            if key not in self._sources:
+                del self._tiers[key]
+                self._tier_jobs.pop(key, None)  # Недостроенные уровни просто не заберем
+
+    def _tier(self, key, images, size):
+        # Самый маленький готовый уровень mipmap (исходник, 1/2, 1/4...), который не меньше size.
+        # Недостающие уровни строятся в scale_pool уменьшением последнего готового и только
+        # по мере надобности; GUI-поток их не ждет, а забирает при следующем вызове
+        tiers = self._tiers.setdefault(key, [])
+        job = self._tier_jobs.get(key)
+        if job is not None and job.done():
+            del self._tier_jobs[key]
+            if job.exception() is None:
+                tiers.extend(job.result())
+        level = images
+        for tier in [images] + tiers:
+            if tier[0].width() < size.width() or tier[0].height() < size.height():
+                break
+            level = tier
+        else:
+            if key not in self._tier_jobs and mipmap_half(level, size) is not None:
+                self._tier_jobs[key] = scale_pool().submit(mipmap_levels, level, size)
+        return level
+
+    def _pinned_bytes(self):
+        # Кадры, которые сейчас на экране, и буферы потоковых декодеров: их не вытеснить
+        in_use = set(self._user_keys.values())
+        pinned = sum(size for key, size in list(self._scaled_bytes.items()) if key in in_use)
+        return pinned + sum(stream.memory_bytes() for stream in list(self._streams.values()))
+
+    def memory_usage(self):
+        scaled = sum(self._scaled_bytes.values())
+        sources = self._sources_bytes()
+        streams = sum(stream.memory_bytes() for stream in self._streams.values())
+        megabyte = 1024 * 1024
+        return {
+            'budget_mb': self.memory_budget / megabyte,
+            'used_mb': (scaled + sources + streams) / megabyte,
+            'scaled_mb': scaled / megabyte,
+            'sources_mb': sources / megabyte,  # Вместе с уровнями mipmap
+            'streams_mb': streams / megabyte,
+            'streams': len(self._streams),
+            'reduced': len(self._reduced),
+        }
+
+    def _scaled_estimate(self, key, size):
+        # Сколько займут кадры под размер окна; без скана (не GIF) — по декодированному исходнику
+        if key in self._sources:
+            count = len(self._sources[key][0])
+        else:
+            scan = self._scan(key)
+            if scan is None:
+                return None
+            count = len(scan[2])
+        return count * 4 * size.width() * size.height()
+
+    def _make_room(self, needed):
+        # Освобождает память под needed байт: сначала неиспользуемые размеры, потом исходники.
+        # True, если теперь влезает в бюджет
+        in_use = set(self._user_keys.values())
+        for key in list(self._scaled):
+            if sum(self._scaled_bytes.values()) + self._sources_bytes() + needed <= self.memory_budget:
+                break
+            if key not in in_use:
+                self._drop_scaled(key)
+        while self._sources and (self._pinned_bytes() + self._sources_bytes() + needed > self.memory_budget):
+            self._sources.popitem(last=False)
+            self._forget_tiers()
+        return self._pinned_bytes() + self._sources_bytes() + needed <= self.memory_budget
+
+    def set_memory_budget(self, memory_budget_mb):
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._evict()
+
+    def _drop_scaled(self, key):
+        del self._scaled[key]
+        self._scaled_bytes.pop(key, None)
+        self._reduced.discard(key)
+
+    def _store_scaled(self, scaled_key, entry, reduced=False):
+        self._scaled[scaled_key] = entry
+        self._scaled.move_to_end(scaled_key)
+        self._scaled_bytes[scaled_key] = sum(pixmap.width() * pixmap.height() * 4 for pixmap in entry[0])
+        if reduced:
+            self._reduced.add(scaled_key)
+        else:
+            self._reduced.discard(scaled_key)
+
+    def _add_source(self, key, decoded):
+        self._sources[key] = decoded
+        self._sources.move_to_end(key)
+        # Исходники нужны только для пересчета размеров: кроме тех, что сейчас на экране
+        # (иначе следующий resize окна декодирует гифку заново в GUI-потоке), держим
+        # последние два файла. Лимит памяти вытесняет и экранные, см. _make_room
+        in_use = {scaled_key[:2] for scaled_key in self._user_keys.values()}
+        spare = [source_key for source_key in self._sources if source_key not in in_use]
+        for source_key in spare[:-2]:
+            del self._sources[source_key]
+        self._forget_tiers()
+
+    def predecode(self, gif_path, size):
+        # Для фонового потока: декодирует и масштабирует кадры, не меняя кэш.
+        # Готовое кладется в кэш через insert() уже в GUI-потоке, где можно создать QPixmap
+        key = self._source_key(gif_path)
+        if key is None or self._stream_delays(key, size) is not None:
+            return None  # Нет файла или гифка для потокового режима, там готовить нечего
+        decoded = self._sources.get(key) or decode_source(gif_path)
+        if decoded is None:
+            return None
+        return key, QSize(size), decoded, scale_frames(decoded[0], size)
+
+    def insert(self, prepared, user=None):
+        key, size, decoded, scaled = prepared
+        self._add_source(key, decoded)
+        scaled_key = key + (size.width(), size.height())
+        self._store_scaled(scaled_key, ([QPixmap.fromImage(image) for image in scaled], decoded[1],
+                                        self._scaled_rects(key, decoded[0], size)))
+        if user is not None:
+            self._user_keys[user] = scaled_key
+        self._evict()
+
+    def _stream_delays(self, key, size):
+        # Задержки кадров, если гифка целиком (исходник и кадры под окно) не влезает
+        # в бюджет одной гифки или в то, что осталось от общего бюджета
+        scan = self._scan(key)
+        if scan is None:
+            return None
+        width, height, delays, _ = scan
+        estimate = len(delays) * 4 * size.width() * size.height()
+        if key not in self._sources:
+            estimate += len(delays) * 4 * width * height
+            if estimate > self.decode_budget:
+                return delays
+        if estimate > self.memory_budget - self._pinned_bytes():
+            return delays
+        return None
+
+    def _close_stream(self, user):
+        stream = self._streams.pop(user, None)
+        if stream is not None:
+            stream.close()
+
+    def get(self, gif_path, size, user=None, approximate=False):
+        # approximate: если точного размера нет в кэше, вместо пересчета вернуть QImage
+        # ближайшего уровня mipmap; точные кадры потом готовятся через predecode/insert
+        key = self._source_key(gif_path)
+        if key is None:
+            return None
+        self._close_stream(user)
+        if user is not None:
+            self._user_keys.pop(user, None)  # Прежние кадры проигрывателя больше не держим в бюджете
+        scaled_key = key + (size.width(), size.height())
+        stream_delays = None if scaled_key in self._scaled else self._stream_delays(key, size)
+        if stream_delays is not None:
+            log.info("Потоковое декодирование %s (%d кадров)", gif_path, len(stream_delays))
+            stream = StreamingFrames(gif_path, size, stream_delays, self.lookahead)
+            if user is not None:
+                self._streams[user] = stream
+            if metrics.enabled:
+                metrics.cache_misses += 1
+            return stream, stream_delays, None
+
+        if scaled_key in self._scaled:
+            self._scaled.move_to_end(scaled_key)
+            if user is not None:
+                self._user_keys[user] = scaled_key
+            if metrics.enabled:
+                metrics.cache_hits += 1
+            return self._scaled[scaled_key]
+
+        if approximate:
+            source = self._get_source(key)
+            if source is None:
+                return None
+            return self._tier(key, source[0], size), source[1], None
+
+        started = time.perf_counter()
+        estimate = self._scaled_estimate(key, size)
+        fits = self._make_room(estimate or 0)
+        source = self._get_source(key)
+        if source is None:
+            return None
+        images, delays = source
+        if estimate is None:
+            fits = self._make_room(len(images) * 4 * size.width() * size.height())
+        render_size, scale = size, 1.0
+        if not fits:
+            # Потоково не сыграть (не GIF), поэтому храним кадры в меньшем разрешении,
+            # а растягивает их при отрисовке Qt через devicePixelRatio
+            room = self.memory_budget - self._pinned_bytes() - self._sources_bytes()
+            scale = (max(room, 0) / (len(images) * 4 * size.width() * size.height())) ** 0.5
+            scale = min(max(scale, MIN_RENDER_SCALE), 1.0)
+            render_size = QSize(max(int(size.width() * scale), 1), max(int(size.height() * scale), 1))
+            log.info("Не хватает памяти под кадры %s, разрешение понижено до %dx%d",
+                     gif_path, render_size.width(), render_size.height())
+        pixmaps = []
+        for image in scale_frames(images, render_size):
+            pixmap = QPixmap.fromImage(image)
+            if render_size != size:
+                pixmap.setDevicePixelRatio(render_size.width() / size.width())
+            pixmaps.append(pixmap)
+        rects = self._scaled_rects(key, images, size) if render_size == size else None
+        entry = (pixmaps, delays, rects)
+        self._store_scaled(scaled_key, entry, reduced=render_size != size)
+        if user is not None:
+            self._user_keys[user] = scaled_key
+        self._evict()
+        if metrics.enabled:
+            metrics.cache_misses += 1
+            metrics.decode_ms += (time.perf_counter() - started) * 1000
+        return entry
+
+    def release(self, user):
+        self._close_stream(user)
+        self._user_keys.pop(user, None)
+        self._evict()
+
+    def _evict(self):
+        # Вытесняем давно не использованные размеры, но не те, что сейчас на экране
+        in_use = set(self._user_keys.values())
+        for key in list(self._scaled):
+            if len(self._scaled) <= self.max_entries:
+                break
+            if key not in in_use:
+                self._drop_scaled(key)
+        self._make_room(0)
+
+    def clear(self):
+        self._sources.clear()
+        self._scaled.clear()
+        self._scaled_bytes.clear()
+        self._reduced.clear()
+        self._tiers.clear()
+        self._tier_jobs.clear()
+        self._scans.clear()
+        self._rects.clear()
+
+
+class AnimationClock(QObject):
+    # Общие часы для всех проигрывателей процесса: один таймер будит всех,
+    # кому пора сменить кадр, и засыпает до ближайшей следующей смены
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.elapsed = QElapsedTimer()
+        self.elapsed.start()
+        self.players = weakref.WeakSet()
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.tick)
+
+    def now(self):
+        return self.elapsed.elapsed()
+
+    def add(self, player):
+        self.players.add(player)
+        self.timer.start(0)
+
+    def remove(self, player):
+        self.players.discard(player)
+
+    def tick(self):
+        now = self.now()
+        wait = None
+        for player in list(self.players):
+            delay = player.advance(now)
+            wait = delay if wait is None else min(wait, delay)
+        if wait is not None:
+            self.timer.start(max(int(wait), 1))
+
+
+class GifPlayer(QObject):
+    # Проигрывает кадры из FrameCache по времени общих часов: кадр выбирается по
+    # позиции в цикле, поэтому после паузы или при ограничении FPS темп GIF сохраняется
+    # Пустой QRect во втором аргументе — перерисовать кадр целиком
+    frameChanged = pyqtSignal(QPixmap, QRect)
+
+    def __init__(self, frame_cache, clock, parent=None):
+        super().__init__(parent)
+        self.frame_cache = frame_cache
+        self.clock = clock
+        self.gif_path = None
+        self.frame_size = None
+        self.pixmaps = []
+        self.stream = None  # StreamingFrames вместо pixmaps для больших гифок
+        self.tier = None  # QImage уровня mipmap вместо pixmaps, пока точный размер не готов
+        self.delays = []
+        self.rects = None  # Измененная область каждого кадра, см. FrameCache._source_rects
+        self.frame_ends = []  # Время окончания каждого кадра от начала цикла (мс)
+        self.frame_index = 0
+        self.origin = 0  # Время часов, с которого идет текущая гифка
+        self.next_due = 0  # Не будить раньше этого времени (ограничение FPS)
+        self.fps_cap = 0
+        self.running = False
+        self.paused = False
+        self.paused_at = 0
+
+    def _set_frames(self, frames):
+        frames, self.delays, self.rects = frames
+        self.stream, self.tier, self.pixmaps = None, None, []
+        if isinstance(frames, StreamingFrames):
+            self.stream = frames
+        elif frames and isinstance(frames[0], QImage):
+            self.tier = frames
+        else:
+            self.pixmaps = frames
+        self.frame_ends = list(accumulate(self.delays))
+
+    def _frame_number(self, now):
+        # Сквозной номер кадра по времени часов: (номер цикла, кадр в цикле)
+        cycle, position = divmod(now - self.origin, self.frame_ends[-1])
+        index = min(bisect_right(self.frame_ends, position), len(self.delays) - 1)
+        return int(cycle) * len(self.delays) + index, index, position
+
+    def _pixmap(self, index, number, timeout=None):
+        if self.tier is not None:
+            image = self.tier[index]
+        elif self.stream is None:
+            return self.pixmaps[index]
+        else:
+            image = self.stream.frame(number, timeout)
+        if image is None:
+            return None
+        if image.size() != self.frame_size:
+            image = image.scaled(self.frame_size, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+        return QPixmap.fromImage(on_white(image))  # Уровни mipmap — исходные кадры, с альфа-каналом
+
+    def load(self, gif_path, size):
+        frames = self.frame_cache.get(gif_path, size, user=self)
+        if frames is None:
+            return False
+        self.gif_path = gif_path
+        self.frame_size = QSize(size)
+        self._set_frames(frames)
+        self.frame_index = 0
+        self.origin = self.next_due = self.clock.now()
+        # В потоковом режиме первый кадр ждем, чтобы окно не осталось пустым
+        pixmap = self._pixmap(0, 0, timeout=1)
+        if pixmap is not None:
+            self.frameChanged.emit(pixmap, QRect())
+        return True
+
+    def set_size(self, size, approximate=False):
+        # С approximate при промахе кэша играет ближайший уровень mipmap и возвращает
+        # False: точные кадры под этот размер нужно подготовить отдельно
+        if self.gif_path is None or (size == self.frame_size and self.tier is None):
+            return True
+        if self.stream is not None:
+            # Потоковый декодер не перезапускаем: он продолжит с того же места в новом размере
+            self.frame_size = QSize(size)
+            self.stream.set_size(size)
+            return True
+        frames = self.frame_cache.get(self.gif_path, size, user=self, approximate=approximate)
+        if frames is None:
+            return True
+        self.frame_size = QSize(size)
+        self._set_frames(frames)
+        self.frame_index %= len(self.delays)
+        self.frameChanged.emit(self._pixmap(self.frame_index, 0), QRect())
+        return self.tier is None
+
+    def set_fps_cap(self, fps):
+        self.fps_cap = max(int(fps or 0), 0)
+
+    def start(self):
+        if self.delays and not self.paused and not self.running:
+            self.running = True
+            self.clock.add(self)
+
+    def stop(self):
+        self.running = False
+        self.clock.remove(self)
+
+    def release(self):
+        self.stop()
+        self.frame_cache.release(self)
+
+    def pause(self):
+        # Время гифки продолжает идти, чтобы после паузы показать кадр, соответствующий времени
+        self.paused = True
+        self.paused_at = self.clock.now()
+        self.stop()
+
+    def resume(self):
+        if not self.paused:
+            return
+        self.paused = False
+        if self.stream is not None:
+            # Потоковый декодер не догонит ушедшее время, поэтому продолжаем с кадра паузы
+            self.origin += self.clock.now() - self.paused_at
+        self.next_due = 0
+        self.start()
+
+    def advance(self, now):
+        # Вызывается часами; возвращает, через сколько мс будить снова
+        if now < self.next_due:
+            return self.next_due - now
+        number, index, position = self._frame_number(now)
+        delay = self.frame_ends[index] - position
+        if index != self.frame_index:
+            pixmap = self._pixmap(index, number)
+            if pixmap is None:
+                # Потоковый декодер не успел: держим текущий кадр и скоро спросим снова
+                return min(delay, STREAM_RETRY_DELAY)
+            if metrics.enabled:
+                metrics.frames += 1
+                metrics.dropped_frames += (index - self.frame_index) % len(self.delays) - 1
+            # Область изменений известна только относительно предыдущего кадра
+            rect = None
+            if self.rects is not None and index == (self.frame_index + 1) % len(self.delays):
+                rect = self.rects[index]
+            self.frame_index = index
+            if rect is None:
+                self.frameChanged.emit(pixmap, QRect())
+            elif not rect.isEmpty():
+                self.frameChanged.emit(pixmap, rect)
+            # Кадр совпадает с предыдущим: окно не трогаем
+        if self.fps_cap:
+            delay = max(delay, 1000 / self.fps_cap)
+        self.next_due = now + delay
+        return delay
+
+
+class GifView(QWidget):
+    # Рисует текущий кадр за один проход: кадр (уже на белой подложке, см. on_white),
+    # скругленные углы и прозрачность через QPainter, без QGraphicsOpacityEffect и маски окна
+    firstPainted = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pixmap = None
+        self.opacity = 1.0
+        self.overlay_text = None  # Текст метрик поверх кадра
+        self._painted = False
+        self.stretch = False  # Растягивать кадр под размер виджета (во время анимации размера)
+        self._clip_path = None
+        self._clip_size = None
+
+    def set_frame(self, pixmap, rect=QRect()):
+        # rect — что изменилось в кадре; при растягивании координаты не совпадают
+        self.pixmap = pixmap
+        if rect.isNull() or self.stretch:
+            self.update()
+        else:
+            self.update(rect)
+
+    def set_opacity(self, opacity):
+        if opacity != self.opacity:
+            self.opacity = opacity
+            self.update()
+
+    def set_stretch(self, stretch):
+        if stretch != self.stretch:
+            self.stretch = stretch
+            self.update()
+
+    def clip_path(self):
+        # Путь скругления пересчитывается только при смене размера
+        if self._clip_size != self.size():
+            self._clip_path = QPainterPath()
+            self._clip_path.addRoundedRect(0, 0, self.width(), self.height(), CORNER_RADIUS, CORNER_RADIUS)
+            self._clip_size = self.size()
+        return self._clip_path
+
+    def paintEvent(self, event):
+        started = time.perf_counter() if metrics.enabled else None
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setClipPath(self.clip_path())
+        painter.setOpacity(self.opacity)
+        area = event.rect()  # При смене кадра это только измененная область
+        if self.pixmap is None:
+            painter.fillRect(area, Qt.white)
+        elif self.stretch:
+            painter.drawPixmap(self.rect(), self.pixmap)
+        else:
+            # Кадр непрозрачный: белым закрашиваем только то, что он не накрывает,
+            # иначе подложка под кадром двоила бы прозрачность
+            covered = QRect(QPoint(0, 0), self.pixmap.size() / self.pixmap.devicePixelRatio())
+            for rect in QRegion(area).subtracted(QRegion(covered)).rects():
+                painter.fillRect(rect, Qt.white)
+            if self.pixmap.devicePixelRatio() != 1:
+                painter.drawPixmap(0, 0, self.pixmap)  # Кадры в пониженном разрешении
+            else:
+                area = area.intersected(covered)
+                painter.drawPixmap(area, self.pixmap, area)
+        if self.overlay_text:
+            painter.setOpacity(1.0)
+            painter.fillRect(8, 8, 190, 116, QColor(0, 0, 0, 160))
+            painter.setPen(Qt.white)
+            painter.setFont(QFont('Consolas', 9))
+            painter.drawText(14, 12, 180, 108, Qt.AlignLeft | Qt.AlignTop, self.overlay_text)
+        painter.end()
+        if started is not None:
+            metrics.blit_ms += (time.perf_counter() - started) * 1000
+            metrics.blits += 1
+        if not self._painted:
+            self._painted = True
+            self.firstPainted.emit()
+
+
+def foreground_covers_screen(window_id, screen_rect):
+    # Windows: виджет закрыт, если сессия заблокирована или на его экране
+    # открыто чужое полноэкранное окно (например, игра)
+    if sys.platform != 'win32':
+        return False
+    import ctypes
+    from ctypes import wintypes
+    user32 = ctypes.windll.user32
+
+    desktop = user32.OpenInputDesktop(0, False, 0x0100)  # DESKTOP_SWITCHDESKTOP
+    if not desktop:
+        return True  # Экран блокировки
+    user32.CloseDesktop(desktop)
+
+    foreground = user32.GetForegroundWindow()
+    if not foreground or foreground == int(window_id) or foreground == user32.GetShellWindow():
+        return False
+    class_name = ctypes.create_unicode_buffer(64)
+    user32.GetClassNameW(foreground, class_name, 64)
+    if class_name.value in ('Progman', 'WorkerW'):
+        return False  # Рабочий стол
+    rect = wintypes.RECT()
+    if not user32.GetWindowRect(foreground, ctypes.byref(rect)):
+        return False
+    return (rect.left <= screen_rect.left() and rect.top <= screen_rect.top()
+            and rect.right >= screen_rect.right() + 1 and rect.bottom >= screen_rect.bottom() + 1)
+
+
+class PlaybackScheduler(QObject):
+    # Останавливает воспроизведение, когда виджет не виден: окно скрыто, свернуто,
+    # не выставлено на экран, экран отключен или поверх открыта полноэкранная игра
+    def __init__(self, window, player, parent=None):
+        super().__init__(parent)
+        self.window = window
+        self.player = player
+        self.user_paused = False  # Пауза по команде пользователя, видимость ее не снимает
+        self._handle = None
+        window.installEventFilter(self)
+        QGuiApplication.instance().screenRemoved.connect(self.update_state)
+
+        self.occlusion_timer = QTimer(self)
+        self.occlusion_timer.setInterval(OCCLUSION_CHECK_INTERVAL)
+        self.occlusion_timer.timeout.connect(self.update_state)
+        if sys.platform == 'win32':
+            self.occlusion_timer.start()
+
+    def attach(self):
+        handle = self.window.windowHandle()
+        if handle is None or handle is self._handle:
+            return
+        handle.installEventFilter(self)
+        handle.visibilityChanged.connect(self.update_state)
+        handle.screenChanged.connect(self.update_state)
+        self._handle = handle
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Show:
+            self.attach()
+        if event.type() in (QEvent.Expose, QEvent.Show, QEvent.Hide, QEvent.WindowStateChange):
+            self.update_state()
+        return False
+
+    def is_visible(self):
+        handle = self.window.windowHandle()
+        if handle is None or not self.window.isVisible() or self.window.isMinimized():
+            return False
+        if not handle.isExposed() or handle.visibility() in (QWindow.Hidden, QWindow.Minimized):
+            return False
+        screen = handle.screen()
+        if screen is None or screen.geometry().isEmpty():
+            return False
+        return not foreground_covers_screen(self.window.winId(), screen.geometry())
+
+    def set_user_paused(self, paused):
+        self.user_paused = paused
+        self.update_state()
+
+    def update_state(self, *args):
+        if sip.isdeleted(self.window):
+            return  # Сигналы QWindow и экранов приходят и во время удаления окна
+        if not self.user_paused and self.is_visible():
+            self.player.resume()
+        elif not self.player.paused:
+            self.player.pause()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class GifLibrary:
+    # Хранилище гифок по хэшу содержимого: один файл на одно содержимое,
+    # индекс с метаданными и вытеснение давно не используемых файлов по квоте
+    def __init__(self, folder=GIF_FOLDER, index_path=GIF_LIBRARY_INDEX, protected_paths=None):
+        self.folder = folder
+        self.index_path = index_path
+        # Файлы, которые нельзя вытеснять (текущая гифка из настроек)
+        self.protected_paths = protected_paths or (lambda: set())
+        self.quota_bytes = GIF_LIBRARY_QUOTA
+        self.entries = {}  # sha256 -> метаданные файла
+        self.files = {}  # имя файла -> sha256, чтобы не искать запись перебором
+        self.urls = {}  # ссылка -> sha256
+        self._lock = threading.RLock()
+        self._save_timer = None  # Отложенная запись индекса (threading.Timer)
+        self._storing = set()  # Гифки, для которых .kfr пишется в фоне
+        self.needs_migration = not os.path.exists(index_path)
+        if not self.needs_migration:
+            self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            self.quota_bytes = int(index.get('quota_bytes', GIF_LIBRARY_QUOTA))
+            self.entries = index.get('entries', {})
+            self.files = {entry['file']: digest for digest, entry in self.entries.items()}
+            self.urls = index.get('urls', {})
+            if index.get('version', 1) < 2:
+                # Несжатые .kfr первой версии писались для каждой гифки и съедали лимит библиотеки
+                for entry in self.entries.values():
+                    if entry.pop('store_size', None) is not None:
+                        store_path = frame_store_path(os.path.join(self.folder, entry['file']))
+                        if os.path.exists(store_path):
+                            os.remove(store_path)
+        except (OSError, ValueError) as e:
+            log.error("Ошибка чтения индекса библиотеки: %s", e)
+            self.needs_migration = True
+
+    def _save_index(self):
+        if self._save_timer is not None:
+            self._save_timer.cancel()  # Пишем все сейчас, отложенная запись больше не нужна
+            self._save_timer = None
+        index = {'version': 2, 'quota_bytes': self.quota_bytes, 'entries': self.entries, 'urls': self.urls}
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    def _schedule_save(self):
+        # Как у SettingsStore: частые мелкие изменения копятся в памяти и пишутся
+        # одним разом. Библиотекой пользуются и фоновые потоки, поэтому threading.Timer, а не QTimer
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(GIF_LIBRARY_SAVE_DELAY / 1000, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._save_timer is None:
+                return
+            try:
+                self._save_index()
+            except OSError as e:
+                log.error("Ошибка сохранения индекса библиотеки: %s", e)
+
+    def _put(self, digest, entry):
+        self.entries[digest] = entry
+        self.files[entry['file']] = digest
+
+    def _drop(self, digest):
+        self.files.pop(self.entries.pop(digest)['file'], None)
+
+    def path_of(self, digest):
+        return os.path.join(self.folder, self.entries[digest]['file'])
+
+    def _describe(self, path, info=None):
+        # Запись индекса для скачанных, перенесенных и импортированных файлов одинаковая:
+        # размеры, кадры и длительность из measure_image (QImageReader.imageCount() у APNG — 1).
+        # Мерить лучше вне блокировки и передавать готовое info: не-GIF для этого декодируется
+        if info is None:
+            try:
+                info = measure_image(path)
+            except ValueError:
+                info = {'width': 0, 'height': 0, 'frames': 0, 'duration': 0}  # Не откроется и при показе
+        return dict(info, file=os.path.basename(path), size=os.path.getsize(path), last_used=time.time())
+
+    def _protected(self):
+        return {os.path.abspath(os.path.expanduser(p)) for p in self.protected_paths() if p}
+
+    def migrate(self):
+        # Однократный перенос старых custom_gif_*.gif в индекс с удалением дубликатов.
+        # Хэшируем без блокировки, чтобы GUI-поток не ждал окончания переноса.
+        for name in sorted(os.listdir(self.folder)):
+            path = os.path.join(self.folder, name)
+            if not name.lower().endswith(('.gif', '.webp', '.png')) or not os.path.isfile(path):
+                continue
+            digest = file_sha256(path)
+            info = None if digest in self.entries else self._describe(path)
+            with self._lock:
+                if digest not in self.entries:
+                    self._put(digest, info or self._describe(path))
+                    continue
+                protected = self._protected()
+                known_path = self.path_of(digest)
+                if os.path.abspath(path) in protected:
+                    # Дубликат, на который ссылаются настройки, оставляем основным
+                    del self.files[self.entries[digest]['file']]
+                    self.entries[digest]['file'] = name
+                    self.files[name] = digest
+                    path = known_path
+                if os.path.abspath(path) not in protected:
+                    os.remove(path)
+        with self._lock:
+            self.needs_migration = False
+            self._save_index()
+        log.info("Библиотека GIF: проиндексировано файлов: %s", len(self.entries))
+
+    def lookup_url(self, url):
+        with self._lock:
+            digest = self.urls.get(url)
+            return self._existing_path(digest)
+
+    def lookup_hash(self, digest):
+        with self._lock:
+            return self._existing_path(digest)
+
+    def _existing_path(self, digest):
+        if digest not in self.entries:
+            return None
+        path = self.path_of(digest)
+        if not os.path.exists(path):
+            self._drop(digest)
+            return None
+        return path
+
+    def add_file(self, src_path, url=None):
+        # Переносит скачанный файл в библиотеку и возвращает итоговый путь
+        digest = file_sha256(src_path)
+        info = self._describe(src_path)
+        with self._lock:
+            path = self._existing_path(digest)
+            if path is None:
+                suffix = IMAGE_SUFFIXES.get(sniff_image_format(src_path), '.gif')
+                path = os.path.join(self.folder, digest + suffix)
+                os.replace(src_path, path)
+                self._put(digest, dict(info, file=os.path.basename(path)))
+            else:
+                os.remove(src_path)
+                self.entries[digest]['last_used'] = time.time()
+            if url:
+                self.urls[url] = digest
+            self._enforce_quota(keep=path)
+            self._save_index()
+        return path
+
+    def import_file(self, src_path, digest, info, move=False, transcode=False):
+        # Для массового импорта: хэш и размеры уже посчитаны, индекс сохраняет вызывающий
+        # через save() раз в несколько файлов. Исходный файл копируется (вне блокировки,
+        # чтобы потоки импорта не ждали друг друга), временный переносится
+        suffix = IMAGE_SUFFIXES.get(sniff_image_format(src_path), '.gif')
+        if not move:
+            tmp_path = os.path.join(self.folder, f"{digest}.{threading.get_ident()}.tmp")
+            shutil.copyfile(src_path, tmp_path)
+            src_path = tmp_path
+        with self._lock:
+            path = self._existing_path(digest)
+            if path is None:
+                path = os.path.join(self.folder, digest + suffix)
+                os.replace(src_path, path)
+                self._put(digest, self._describe(path, info))
+                self._enforce_quota(keep=path)
+            else:
+                os.remove(src_path)
+        if transcode:
+            self._add_frame_store(digest, path)
+        return path
+
+    def digest_of(self, path):
+        # Хэш гифки по пути к файлу в папке библиотеки; для чужих файлов — None
+        if not in_gif_folder(path):
+            return None
+        with self._lock:
+            return self.files.get(os.path.basename(path))
+
+    def prepare_frame_store(self, path):
+        # Показанной гифке .kfr готовится в фоне: при следующем запуске кадры
+        # читаются из него без разбора GIF. Чужие файлы и уже готовые .kfr пропускаем
+        digest = self.digest_of(path)
+        if digest is None or os.path.exists(frame_store_path(path)):
+            return
+        with self._lock:
+            if digest in self._storing:
+                return
+            self._storing.add(digest)
+        threading.Thread(target=self._store_frames, args=(digest, path), name='kiwi-frame-store', daemon=True).start()
+
+    def _store_frames(self, digest, path):
+        try:
+            self._add_frame_store(digest, path)
+        except OSError as e:
+            log.error("Ошибка подготовки %s: %s", frame_store_path(path), e)
+        finally:
+            with self._lock:
+                self._storing.discard(digest)
+
+    def store_frames(self, path):
+        # Синхронный вариант prepare_frame_store; возвращает размер .kfr или None
+        digest = self.digest_of(path)
+        if digest is None:
+            return None
+        return self._add_frame_store(digest, path)
+
+    def save(self):
+        with self._lock:
+            self._save_index()
+
+    def _add_frame_store(self, digest, path):
+        # .kfr пишется для показанной гифки и при импорте с --transcode, вне блокировки: это долго,
+        # а индекс нужен GUI-потоку. Место под .kfr ограничено отдельно, FRAME_STORE_QUOTA
+        if os.path.exists(frame_store_path(path)):
+            return None
+        store_size = write_frame_store(path)
+        if store_size is None:
+            return None
+        with self._lock:
+            if digest not in self.entries:
+                os.remove(frame_store_path(path))  # Гифку вытеснили, пока писали ее кадры
+                return None
+            self.entries[digest]['store_size'] = store_size
+            self._enforce_store_quota(keep=digest)
+            self._save_index()
+        return store_size
+
+    def _enforce_store_quota(self, keep=None):
+        # Давно не использованные .kfr удаляются; сами гифки остаются в библиотеке
+        stores = sorted((entry['last_used'], digest) for digest, entry in self.entries.items() if 'store_size' in entry)
+        total = sum(self.entries[digest]['store_size'] for _, digest in stores)
+        for _, digest in stores:
+            if total <= FRAME_STORE_QUOTA:
+                break
+            if digest == keep:
+                continue
+            total -= self.entries[digest].pop('store_size')
+            store_path = frame_store_path(self.path_of(digest))
+            if os.path.exists(store_path):
+                os.remove(store_path)
+
+    def touch(self, path):
+        # Вызывается при каждом показе гифки: время меняется в памяти, индекс пишется позже
+        with self._lock:
+            digest = self.digest_of(path)
+            if digest is not None:
+                self.entries[digest]['last_used'] = time.time()
+                self._schedule_save()
+
+    def remove(self, path):
+        with self._lock:
+            digest = self.files.get(os.path.basename(path))
+            if digest is not None:
+                self._evict(digest)
+            self._save_index()
+
+    def _evict(self, digest):
+        path = self.path_of(digest)
+        self._drop(digest)
+        self.urls = {url: d for url, d in self.urls.items() if d != digest}
+        for file_path in (path, frame_store_path(path), thumbnail_path(digest)):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def total_size(self):
+        with self._lock:
+            return sum(entry['size'] for entry in self.entries.values())
+
+    def _enforce_quota(self, keep=None):
+        protected = self._protected()
+        if keep:
+            protected.add(os.path.abspath(keep))
+        total = sum(entry['size'] for entry in self.entries.values())  # .kfr считаются отдельно
+        for digest, entry in sorted(self.entries.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.quota_bytes:
+                break
+            if os.path.abspath(self.path_of(digest)) in protected:
+                continue
+            total -= entry['size']
+            log.info("Библиотека GIF: вытеснен %s", entry['file'])
+            self._evict(digest)
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+def is_url(text):
+    return text.lower().startswith(('http://', 'https://'))
+
+
+class HttpClient:
+    # Общий HTTP-клиент процесса: одна сессия requests с пулом keep-alive соединений,
+    # таймауты по умолчанию, gzip и условные запросы по ETag/Last-Modified,
+    # которые хранятся в HTTP_CACHE_FILE
+    def __init__(self, cache_path=HTTP_CACHE_FILE):
+        self.cache_path = cache_path
+        self.validators = {}  # ссылка -> {'etag': ..., 'last_modified': ...}
+        self.offline_until = 0  # До этого времени (time.monotonic) считаем, что сети нет
+        self._session = None
+        self._lock = threading.Lock()
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                self.validators = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                import requests  # Тяжелый импорт, только при первом сетевом запросе
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers['Accept-Encoding'] = 'gzip, deflate'
+                self._session = session
+            return self._session
+
+    def is_offline(self):
+        return time.monotonic() < self.offline_until
+
+    def get(self, url, headers=None, stream=False, conditional=False):
+        # conditional: ответ на эту ссылку у нас уже есть, тело нужно, только если он изменился (иначе 304)
+        import requests
+        headers = dict(headers or {})
+        if conditional:
+            with self._lock:
+                cached = self.validators.get(url, {})
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        try:
+            response = self.session().get(url, headers=headers, stream=stream, timeout=DOWNLOAD_TIMEOUT)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.offline_until = time.monotonic() + HTTP_OFFLINE_RETRY
+            raise
+        self.offline_until = 0
+        return response
+
+    def remember(self, url, response):
+        # Валидаторы полностью полученного ответа для следующих условных запросов
+        entry = {}
+        if response.headers.get('ETag'):
+            entry['etag'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            entry['last_modified'] = response.headers['Last-Modified']
+        with self._lock:
+            if self.validators.get(url) == (entry or None):
+                return
+            if entry:
+                self.validators[url] = entry
+            else:
+                self.validators.pop(url, None)
+            tmp_path = self.cache_path + '.tmp'
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.validators, f, ensure_ascii=False, indent=1)
+                os.replace(tmp_path, self.cache_path)
+            except OSError as e:
+                log.error("Ошибка сохранения кэша HTTP: %s", e)
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def http_client():
+    # Вызывается из рабочих потоков загрузки, поэтому создание под блокировкой
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HttpClient()
+        return _http_client
+
+
+def partial_download_path(url):
+    # Имя временного файла зависит только от ссылки, чтобы после обрыва докачать его
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(GIF_FOLDER, f"download_{digest}.part")
+
+
+def stream_download(url, part_path, progress_callback=None, is_cancelled=None, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                    conditional=False):
+    # Качаем по кускам прямо во временный файл, без буферизации всего ответа в памяти.
+    # Если временный файл уже есть, продолжаем с его конца через HTTP Range.
+    # С conditional возвращает None, если ответ не изменился (304)
+    import requests
+    resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    # Range считается по байтам на проводе, поэтому докачиваем без сжатия
+    headers = {'Range': f'bytes={resume_from}-', 'Accept-Encoding': 'identity'} if resume_from else {}
+
+    client = http_client()
+    with client.get(url, headers=headers, stream=True, conditional=conditional) as response:
+        if response.status_code == 304:
+            return None
+        if response.status_code == 416:
+            # Сервер не может отдать хвост: начинаем заново
+            resume_from = None
+        else:
+            response.raise_for_status()
+            if response.status_code == 206:
+                mode, received = 'ab', resume_from
+            else:
+                mode, received = 'wb', 0  # Сервер не поддерживает Range, качаем целиком
+            # Со сжатием Content-Length — размер сжатого тела, прогресс в процентах не посчитать
+            length = 0 if response.headers.get('Content-Encoding') else int(response.headers.get('Content-Length', 0))
+            total = received + length if length else 0
+
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size):
+                    if is_cancelled and is_cancelled():
+                        raise DownloadCancelled(url)
+                    if not chunk:
+                        continue
+                    f.write(chunk)
+                    received += len(chunk)
+                    if progress_callback:
+                        progress_callback(received, total)
+
+            if total and received < total:
+                raise requests.exceptions.ConnectionError(f"Соединение оборвалось: получено {received} из {total} байт")
+            client.remember(url, response)
+            return received
+
+    os.remove(part_path)
+    return stream_download(url, part_path, progress_callback, is_cancelled, chunk_size, conditional)
+
+
+def download_to_library(url, library, progress_callback=None, is_cancelled=None):
+    # Качает ссылку с докачкой, проверяет содержимое и переносит файл в библиотеку.
+    # Если ссылка уже есть в библиотеке, тело качается, только если сервер сообщил
+    # об изменении: обычно это один ответ 304, а без сети — свой файл без запроса
+    import requests
+    part_path = partial_download_path(url)
+    cached_path = library.lookup_url(url)
+    if cached_path is None:
+        stream_download(url, part_path, progress_callback, is_cancelled)
+    elif http_client().is_offline():
+        return cached_path
+    else:
+        try:
+            if stream_download(url, part_path, progress_callback, is_cancelled, conditional=True) is None:
+                return cached_path
+        except requests.exceptions.RequestException as e:
+            log.info("Ссылка %s недоступна, берем файл из библиотеки: %s", url, e)
+            return cached_path
+    # Тип проверяем по содержимому: ссылка может быть без расширения или с чужим
+    if sniff_image_format(part_path) is None and not QImageReader(part_path).canRead():
+        os.remove(part_path)
+        raise ValueError("Файл не является GIF, WebP или APNG")
+    # Библиотека переносит файл на место целиком, а дубликат просто удаляет
+    return library.add_file(part_path, url)
+
+
+def thumbnail_path(digest):
+    return os.path.join(THUMBNAIL_FOLDER, digest + '.png')
+
+
+def write_thumbnail(gif_path, digest):
+    # Первый кадр, уменьшенный до THUMBNAIL_SIZE по большей стороне; пишется один раз на содержимое
+    path = thumbnail_path(digest)
+    if os.path.exists(path):
+        return path
+    reader = QImageReader(gif_path)
+    image = reader.read()
+    if image.isNull():
+        raise ValueError(reader.errorString())
+    thumbnail = image.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    os.makedirs(THUMBNAIL_FOLDER, exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    if not thumbnail.save(tmp_path, 'PNG'):
+        raise OSError(f"Не удалось записать превью {path}")
+    os.replace(tmp_path, path)
+    return path
+
+
+def measure_image(gif_path):
+    # Размер, число кадров и длительность цикла; у GIF — по заголовкам, без декодирования
+    scan = scan_gif_frames(gif_path) if sniff_image_format(gif_path) == 'gif' else None
+    if scan is not None:
+        width, height, delays, _ = scan
+    else:
+        decoded = decode_gif_frames(gif_path)
+        if decoded is None:
+            raise ValueError("Не удалось декодировать")
+        images, delays = decoded
+        width, height = images[0].width(), images[0].height()
+    return {'width': width, 'height': height, 'frames': len(delays), 'duration': sum(delays)}
+
+
+def import_sources(source, stack):
+    # Файлы папки (рекурсивно) или члены архива zip/tar: (ключ для журнала, подпись, открыватель).
+    # Подпись меняется вместе с содержимым; открыватель возвращает (путь, временный ли файл).
+    # Член архива извлекается только открывателем в потоке пула, то есть после проверки
+    # журнала; архив закрывает stack (contextlib.ExitStack) после импорта
+    if os.path.isdir(source):
+        for root, _, names in os.walk(source):
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                if os.path.dirname(os.path.abspath(path)) == os.path.abspath(GIF_FOLDER):
+                    continue  # Сама библиотека
+                stat = os.stat(path)
+                yield os.path.relpath(path, source), [stat.st_size, stat.st_mtime_ns], lambda path=path: (path, False)
+        return
+    import zipfile
+    import tarfile
+    if zipfile.is_zipfile(source):
+        archive = stack.enter_context(zipfile.ZipFile(source))  # ZipFile сам разделяет чтение между потоками
+        for member in archive.infolist():
+            if not member.is_dir():
+                yield member.filename, [member.file_size, member.CRC], \
+                    lambda member=member: (extract_import_member(archive.open(member), member.filename), True)
+        return
+    if tarfile.is_tarfile(source):
+        # TarFile не рассчитан на потоки, поэтому члены извлекаются по очереди под блокировкой
+        archive = stack.enter_context(tarfile.open(source))
+        lock = threading.Lock()
+
+        def extract(member):
+            with lock:
+                return extract_import_member(archive.extractfile(member), member.name), True
+
+        for member in archive.getmembers():
+            if member.isfile():
+                yield member.name, [member.size, member.mtime], lambda member=member: extract(member)
+        return
+    raise ValueError(f"Не папка и не архив: {source}")
+
+
+def extract_import_member(stream, name):
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(GIF_FOLDER, f"import_{digest}_{threading.get_ident()}.part")
+    with stream, open(path, 'wb') as f:
+        shutil.copyfileobj(stream, f, DOWNLOAD_CHUNK_SIZE)
+    return path
+
+
+def import_one(library, opener, transcode):
+    # Один файл импорта в потоке пула: проверка, хэш, размеры, превью и (по желанию) .kfr
+    path, temporary = opener()
+    try:
+        if sniff_image_format(path) not in ('gif', 'webp', 'apng'):
+            raise ValueError("Не GIF, WebP или APNG")
+        digest = file_sha256(path)
+        write_thumbnail(path, digest)
+        if library.lookup_hash(digest) is None:
+            info = measure_image(path)
+            library.import_file(path, digest, info, move=temporary, transcode=transcode)
+            temporary = False
+        return digest
+    finally:
+        if temporary and os.path.exists(path):
+            os.remove(path)
+
+
+def import_to_library(source, library, progress_callback=None, is_cancelled=None, transcode=False):
+    # Массовый импорт папки или архива в библиотеку. Файлы обрабатываются параллельно:
+    # хэширование, чтение и Qt отпускают GIL, поэтому потоки пула занимают все ядра.
+    # Готовые файлы записываются в IMPORT_JOURNAL, и прерванный импорт при повторном
+    # запуске пропускает их, не читая заново
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+    from contextlib import ExitStack
+    import tarfile
+    import zipfile
+    source = os.path.abspath(os.path.expanduser(source))
+    try:
+        with open(IMPORT_JOURNAL, 'r', encoding='utf-8') as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        journal = {}
+    done = journal.setdefault(source, {})
+    result = {'total': 0, 'imported': 0, 'skipped': 0, 'failed': []}
+    stack = ExitStack()
+    items = []
+    try:
+        for key, signature, opener in import_sources(source, stack):
+            previous = done.get(key)
+            if previous and previous[:2] == signature and library.lookup_hash(previous[2]) is not None:
+                result['skipped'] += 1
+            else:
+                items.append((key, signature, opener))
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+        stack.close()
+        raise ValueError(f"Архив поврежден: {e}")
+    except Exception:
+        stack.close()
+        raise
+    result['total'] = result['skipped'] + len(items)
+
+    def save():
+        library.save()
+        tmp_path = IMPORT_JOURNAL + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(journal, f, ensure_ascii=False)
+        os.replace(tmp_path, IMPORT_JOURNAL)
+
+    finished = result['skipped']
+    workers = os.cpu_count() or 1
+    with stack, ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kiwi-import') as pool:
+        pending = {}
+        queue = iter(items)
+        while True:
+            # Держим в пуле ограниченную очередь: члены архива извлекаются по мере надобности,
+            # и после отмены неизвлеченные не оставляют временных файлов
+            while len(pending) < workers * 2 and not (is_cancelled and is_cancelled()):
+                item = next(queue, None)
+                if item is None:
+                    break
+                pending[pool.submit(import_one, library, item[2], transcode)] = item
+            if not pending:
+                break
+            completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                key, signature, _ = pending.pop(future)
+                try:
+                    done[key] = signature + [future.result()]
+                    result['imported'] += 1
+                except (OSError, ValueError, struct.error, zlib.error, tarfile.TarError, zipfile.BadZipFile) as e:
+                    result['failed'].append([key, str(e)])
+                finished += 1
+                if finished % IMPORT_SAVE_EVERY == 0:
+                    save()
+                if progress_callback:
+                    progress_callback(finished, result['total'])
+    save()
+    result['cancelled'] = bool(is_cancelled and is_cancelled()) and finished < result['total']
+    log.info("Импорт %s: %s", source, {key: value if key != 'failed' else len(value) for key, value in result.items()})
+    return result
+
+
+class GifDownloadThread(QThread):
+    # Загрузка GIF вне GUI-потока; старая гифка играет, пока файл не докачан
+    progress = pyqtSignal(int, int)
+    downloaded = pyqtSignal(str, str)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, url, library, parent=None):
+        super().__init__(parent)
+        self.url = url
+        self.library = library
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        import requests  # Импортируем в рабочем потоке, а не при старте программы
+        try:
+            gif_path = download_to_library(self.url, self.library, self.progress.emit, lambda: self._cancelled)
+        except DownloadCancelled:
+            return  # Временный файл остается для докачки
+        except (requests.exceptions.RequestException, OSError, ValueError) as e:
+            self.failed.emit(self.url, str(e))
+            return
+        self.downloaded.emit(self.url, gif_path)
+
+
+class PrefetchThread(QThread):
+    # Готовит следующий элемент плейлиста: ссылку качает в библиотеку, затем
+    # декодирует кадры под размер окна, не занимая GUI-поток
+    ready = pyqtSignal(str, str)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, item, library, frame_cache, size, parent=None):
+        super().__init__(parent)
+        self.item = item
+        self.library = library
+        self.frame_cache = frame_cache
+        self.size = QSize(size)
+        self.frames = None  # Результат FrameCache.predecode
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        import requests  # Импортируем в рабочем потоке, а не при старте программы
+        try:
+            if is_url(self.item):
+                gif_path = download_to_library(self.item, self.library, is_cancelled=lambda: self._cancelled)
+            else:
+                gif_path = os.path.abspath(os.path.expanduser(self.item))
+                if not os.path.isfile(gif_path):
+                    raise OSError(f"Файл не найден: {gif_path}")
+            self.frames = self.frame_cache.predecode(gif_path, self.size)
+        except DownloadCancelled:
+            return
+        except (requests.exceptions.RequestException, OSError, ValueError) as e:
+            self.failed.emit(self.item, str(e))
+            return
+        if not self._cancelled:
+            self.ready.emit(self.item, gif_path)
+
+
+class ImportThread(QThread):
+    # Массовый импорт папки или архива в библиотеку, см. import_to_library
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, source, library, transcode=False, parent=None):
+        super().__init__(parent)
+        self.source = source
+        self.library = library
+        self.transcode = transcode
+        self.finished_count = 0
+        self.total = 0
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def on_progress(self, finished, total):
+        self.finished_count, self.total = finished, total
+        self.progress.emit(finished, total)
+
+    def run(self):
+        try:
+            result = import_to_library(self.source, self.library, self.on_progress, lambda: self._cancelled,
+                                       self.transcode)
+        except (OSError, ValueError) as e:
+            self.failed.emit(str(e))
+            return
+        self.done.emit(result)
+
+
+class ScaleThread(QThread):
+    # Точный пересчет кадров под новый размер окна, пока на экране уровень mipmap
+    def __init__(self, gif_path, frame_cache, size, parent=None):
+        super().__init__(parent)
+        self.gif_path = gif_path
+        self.frame_cache = frame_cache
+        self.size = QSize(size)
+        self.frames = None  # Результат FrameCache.predecode
+
+    def run(self):
+        self.frames = self.frame_cache.predecode(self.gif_path, self.size)
+
+
+class AvatarDownloadThread(QThread):
+    # Аватарка не нужна для первого кадра, поэтому качаем ее в фоне
+    downloaded = pyqtSignal(str)
+
+    def run(self):
+        path = download_avatar_image()
+        if os.path.exists(path):
+            self.downloaded.emit(path)
+
+
 class CustomSlider(QSlider):
     def __init__(self, orientation, parent=None):
         super().__init__(orientation, parent)
@@ -97,7 +2443,7 @@ class CustomSlider(QSlider):
         if parent_window:
             parent_window.set_gif_opacity(value)
             parent_window.save_opacity(value)
-        print(f"CustomSlider: Изменено значение прозрачности на {value}")
+        log.debug("CustomSlider: Изменено значение прозрачности на %s", value)
 
 
     def paintEvent(self, event):
@@ -117,12 +2463,110 @@ class CustomSlider(QSlider):
         painter.drawText(text_rect, Qt.AlignCenter, f"{value}%")
         painter.end()
 
+class Playlist(QObject):
+    # Ротация гифок виджета по таймеру или вручную. Следующий элемент заранее
+    # качается и декодируется под размер окна в фоне, и смена — это один кадр из кэша
+    def __init__(self, window):
+        super().__init__(window)
+        self.window = window
+        self.items = list(window.settings.get('playlist') or [])
+        self.index = window.settings.get('playlist_index') or 0
+        self.prefetch_thread = None
+        self.prefetched = None  # (элемент, путь) уже готового следующего элемента
+        self.switch_pending = False  # Смену попросили раньше, чем элемент был готов
+        self.failures = 0
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.next)
+        self._start_timer(window.settings.get('playlist_interval'))
+
+    def _start_timer(self, interval):
+        if self.items and interval:
+            self.timer.start(int(interval) * 1000)
+        else:
+            self.timer.stop()
+
+    def configure(self, items, interval):
+        self.window.settings.set('playlist', items)
+        self.window.settings.set('playlist_interval', interval)
+        self.items = list(items)
+        self.index = -1  # Первая смена покажет первый элемент списка
+        self.window.settings.set('playlist_index', self.index)
+        self.prefetched = None
+        self.failures = 0
+        self.window.frame_cache.release(self)
+        if self.prefetch_thread is not None:
+            self.prefetch_thread.cancel()
+            self.prefetch_thread = None
+        self._start_timer(interval)
+        self.switch_pending = bool(self.items)  # Новый плейлист начинаем сразу, как будет готов
+        self.prefetch()
+
+    def next_item(self):
+        return self.items[(self.index + 1) % len(self.items)]
+
+    def prefetch(self):
+        if not self.items or self.prefetch_thread is not None or self.prefetched is not None:
+            return
+        thread = PrefetchThread(self.next_item(), self.window.gif_library, self.window.frame_cache,
+                                self.window.gif_frame_size(), self)
+        thread.ready.connect(self.on_prefetched)
+        thread.failed.connect(self.on_prefetch_failed)
+        thread.finished.connect(thread.deleteLater)
+        self.prefetch_thread = thread
+        thread.start()
+
+    def on_prefetched(self, item, gif_path):
+        thread = self.sender()
+        if thread is not self.prefetch_thread:
+            return  # Плейлист поменяли, пока поток работал
+        self.prefetch_thread = None
+        if thread.frames is not None:
+            # Кадры держим в кэше за плейлистом, пока их не заберет проигрыватель
+            self.window.frame_cache.insert(thread.frames, user=self)
+        self.prefetched = (item, gif_path)
+        self.failures = 0
+        if self.switch_pending:
+            self.next()
+
+    def on_prefetch_failed(self, item, error):
+        if self.sender() is not self.prefetch_thread:
+            return
+        self.prefetch_thread = None
+        log.warning("Плейлист: пропущен %s: %s", item, error)
+        self.failures += 1
+        if self.failures >= len(self.items):
+            self.switch_pending = False
+            return  # Не готов ни один элемент, ждем следующего изменения плейлиста
+        self.index = (self.index + 1) % len(self.items)
+        self.prefetch()
+
+    def next(self):
+        if not self.items:
+            return
+        if self.prefetched is None:
+            self.switch_pending = True
+            self.prefetch()
+            return
+        item, gif_path = self.prefetched
+        self.prefetched = None
+        self.switch_pending = False
+        self.index = (self.index + 1) % len(self.items)
+        self.window.settings.set('playlist_index', self.index)
+        if not self.window.show_gif(gif_path):
+            log.warning("Плейлист: не удалось показать %s", item)
+        self.window.frame_cache.release(self)
+        self.prefetch()
+
+    def prefetched_path(self):
+        return self.prefetched[1] if self.prefetched else None
+
+
 class OptionPopup(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.opacity_slider = QSlider(self)
         self.opacity_slider.setVisible(False)
-        self.setFixedSize(200, 450)
+        self.setFixedSize(200, 625)
 
         self.setWindowFlags(Qt.Popup | Qt.FramelessWindowHint)
         self.setAttribute(Qt.WA_TranslucentBackground)
@@ -140,10 +2584,13 @@ class OptionPopup(QWidget):
         self.move_button = self.create_styled_button("#4caf50", "Перемещение: ВЫКЛ.", self.parent().toggle_move_mode)
         self.resize_button = self.create_styled_button("#2196f3", "Изменить размер", self.parent().change_size)
         self.change_gif_button = self.create_styled_button("#ff9800", "Изменить GIF", self.parent().change_gif)
+        self.playlist_button = self.create_styled_button("#009688", "Плейлист", self.parent().edit_playlist)
         self.restart_button = self.create_styled_button("#9e9e9e", "Рестарт", self.parent().restart_application)
+        self.new_widget_button = self.create_styled_button("#673ab7", "Новый виджет", self.parent().spawn_widget)
+        self.import_button = self.create_styled_button("#795548", "Импорт папки", self.parent().import_folder)
         self.opacity_slider.setVisible(False)
         self.autostart_checkbox = QCheckBox("Автозапуск", self)
-        self.autostart_checkbox.setChecked(self.parent().load_autostart())
+        self.autostart_checkbox.setChecked(autostart_exists())
         self.autostart_checkbox.stateChanged.connect(self.parent().toggle_autostart)
         self.autostart_checkbox.setStyleSheet("""
             QCheckBox {
@@ -170,8 +2617,6 @@ class OptionPopup(QWidget):
             parent_window.load_opacity()  # Устанавливаем значение из родителя
             self.opacity_slider.setValue(parent_window.opacity_slider.value())  # Устанавливаем значение ползунка в OptionPopup
 
-        self.opacity_slider.valueChanged.connect(self.update_opacity)
-
         self.opacity_slider.setStyleSheet("""
             QSlider::groove:horizontal {
                 background: rgba(34, 30, 32, 8);
@@ -199,21 +2644,15 @@ class OptionPopup(QWidget):
         layout.addWidget(self.move_button)
         layout.addWidget(self.resize_button)
         layout.addWidget(self.change_gif_button)
+        layout.addWidget(self.playlist_button)
         layout.addWidget(self.restart_button)
+        layout.addWidget(self.new_widget_button)
+        layout.addWidget(self.import_button)
         layout.addWidget(self.autostart_checkbox)
         layout.addWidget(self.opacity_slider)
         layout.setAlignment(Qt.AlignTop)
 
 
-    def update_opacity(self, value):
-        parent_window = self.parent()
-        while parent_window and not hasattr(parent_window, 'set_gif_opacity'):
-            parent_window = parent_window.parent()
-        if parent_window:
-            parent_window.set_gif_opacity(value)
-            parent_window.save_opacity(value)
-        print(f"OptionPopup: Изменено значение прозрачности на {value}")
-
     def create_styled_button(self, color, text, callback):
         button = QPushButton(text, self)
         button.setStyleSheet(f"""
@@ -239,23 +2678,23 @@ class OptionPopup(QWidget):
         return qcolor.name()
 
     def fade_in(self):
-        print("Starting fade_in animation")
+        log.debug("Starting fade_in animation")
         self.setWindowOpacity(1)
         animation = QPropertyAnimation(self, b"windowOpacity")
         animation.setDuration(300)  # Длительность анимации в миллисекундах
         animation.setStartValue(0)
         animation.setEndValue(1)
-        animation.finished.connect(lambda: print("Animation complete: fade_in"))
+        animation.finished.connect(lambda: log.debug("Animation complete: fade_in"))
         animation.start()
         self.show()
 
     def fade_out(self):
-        print("Starting fade_out animation")
+        log.debug("Starting fade_out animation")
         animation = QPropertyAnimation(self, b"windowOpacity")
         animation.setDuration(300)  # Длительность анимации в миллисекундах
         animation.setStartValue(1)
         animation.setEndValue(0)
-        animation.finished.connect(lambda: print("Animation complete: fade_out"))
+        animation.finished.connect(lambda: log.debug("Animation complete: fade_out"))
         animation.finished.connect(self.hide)
         animation.start()
 
@@ -263,15 +2702,44 @@ class OptionPopup(QWidget):
 
 
 class TransparentWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, settings=None):
         super().__init__()
         self.setWindowTitle('Kiwi Widget')
 
         self.moving_mode = False  # Флаг режима перемещения
         self.start_pos = None
 
-        self.gif_movie = None  # Инициализируем как None
-        self.gif_label = QLabel(self)
+        # Кэш кадров, часы анимации, библиотека и файл настроек общие для всех виджетов процесса
+        self.manager = widget_manager()
+        self.settings = settings or self.manager.settings.widget_settings(0)
+
+        self.gif_view = GifView(self)
+        self.frame_cache = self.manager.frame_cache
+        self.gif_player = GifPlayer(self.frame_cache, self.manager.clock, self)
+        self.gif_player.frameChanged.connect(self.gif_view.set_frame)
+        self.gif_player.set_fps_cap(self.settings.get('fps_cap'))
+        self.playback_scheduler = PlaybackScheduler(self, self.gif_player, self)
+
+        # Точный размер кадров считается в фоне, когда размер окна перестал меняться
+        self.exact_size_timer = QTimer(self)
+        self.exact_size_timer.setSingleShot(True)
+        self.exact_size_timer.setInterval(EXACT_RESIZE_DELAY)
+        self.exact_size_timer.timeout.connect(self.start_exact_scale)
+        self.scale_thread = None
+
+        # Таймер для изменения размеров гифки
+        self.resize_timer = QTimer()
+        self.resize_timer.setTimerType(Qt.PreciseTimer)
+        self.resize_timer.timeout.connect(self.animate_resize)
+        self.resize_clock = QElapsedTimer()
+        self.resize_easing = QEasingCurve(QEasingCurve.OutCubic)
+
+        self.resize_start_size = None
+        self.target_size = None  # Целевая величина для изменения размеров
+        self.download_thread = None  # Текущая фоновая загрузка GIF
+        self.import_thread = None  # Текущий массовый импорт в библиотеку
+        self.gif_library = self.manager.gif_library
+        self.playlist = Playlist(self)  # Следующий элемент начнет готовиться после первого кадра
         self.opacity_slider = QSlider(self)
         self.opacity_slider.setVisible(False)
         self.opacity_slider.setRange(30, 100)  # Установи диапазон значений ползунка
@@ -296,118 +2764,129 @@ class TransparentWindow(QMainWindow):
         self.setAttribute(Qt.WA_TranslucentBackground)
         self.setWindowOpacity(1)
 
-        self.setMask(self.create_mask())
-
-        # Загружаем аватарку
-        download_avatar_image()
-        self.setWindowIcon(QIcon(AVATAR_IMAGE_PATH))
+        # Иконка из комплекта сразу, аватарка из сети — в фоне после первого кадра
+        self.setWindowIcon(QIcon(AVATAR_IMAGE_PATH if os.path.exists(AVATAR_IMAGE_PATH) else ICON_PATH))
+        self.first_paint_ms = None
+        self.gif_view.firstPainted.connect(self.on_first_paint)
 
         # Загрузка последнего GIF
         self.load_last_gif_path()
 
-        self.gif_label.setGeometry(0, 0, self.width(), self.height())
-        if self.gif_movie:
-            self.gif_movie.setScaledSize(self.gif_label.size())
-            self.gif_movie.start()
-
-        self.gif_label.setStyleSheet("background-color: white; border-radius: 20px;")  # Белый фон для gif_label
+        self.gif_view.setGeometry(0, 0, self.width(), self.height())
+        self.gif_player.start()
 
-        self.gif_label.setContextMenuPolicy(Qt.CustomContextMenu)
-        self.gif_label.customContextMenuRequested.connect(self.toggle_menu)
+        self.gif_view.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.gif_view.customContextMenuRequested.connect(self.toggle_menu)
 
         # Добавь этот код для обработки ПКМ
-        self.gif_label.setContextMenuPolicy(Qt.CustomContextMenu)
-        self.gif_label.customContextMenuRequested.connect(self.showContextMenu)
-
-        # Создаем всплывающее окно для параметров
-        self.option_popup = OptionPopup(self)
-
-        # Устанавливаем начальный текст кнопки перемещения
-        self.update_move_button_text()
-
-        # Таймер для изменения размеров гифки
-        self.resize_timer = QTimer()
-        self.resize_timer.timeout.connect(self.animate_resize)
-
-        self.target_size = None  # Целевая величина для изменения размеров
-
-
+        self.gif_view.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.gif_view.customContextMenuRequested.connect(self.showContextMenu)
+
+        # Всплывающее окно параметров создается при первом обращении
+        self._option_popup = None
+        # Только полностью собранное окно: поток переноса библиотеки читает его плейлист
+        self.manager.windows.append(self)
+
+
+
+    @property
+    def option_popup(self):
+        if self._option_popup is None:
+            self._option_popup = OptionPopup(self)
+            self.update_move_button_text()
+        return self._option_popup
+
+    def on_first_paint(self):
+        self.first_paint_ms = (time.perf_counter() - self.manager.started) * 1000
+        log.info("Первый кадр отрисован через %.0f мс", self.first_paint_ms)
+        if self.first_paint_ms > STARTUP_BUDGET_MS:
+            log.warning("Старт медленнее бюджета %s мс", STARTUP_BUDGET_MS)
+        if not os.path.exists(AVATAR_IMAGE_PATH):
+            self.avatar_thread = AvatarDownloadThread(self)
+            self.avatar_thread.downloaded.connect(self.on_avatar_downloaded)
+            self.avatar_thread.start()
+        self.playlist.prefetch()
+
+    def on_avatar_downloaded(self, path):
+        self.setWindowIcon(QIcon(path))
+
+    def spawn_widget(self):
+        # Новый виджет в том же процессе: та же гифка, кадры берутся из общего кэша
+        window = self.manager.add_widget({
+            'geometry': [self.width(), self.height(), self.x() + 30, self.y() + 30],
+            'opacity': self.settings.get('opacity'),
+            'last_gif': self.gif_player.gif_path,
+        })
+        window.show()
 
     def text(self, value):
         text = ("Прозрачность")
 
     def save_opacity(self, value):
-        with open(OPACITY_FILE, "w") as file:
-            file.write(str(value))
-        print(f"Сохранено значение: {value} в {OPACITY_FILE}")
+        self.settings.set('opacity', value)
 
     def load_opacity(self):
-        try:
-            with open(OPACITY_FILE, "r") as file:
-                value = int(file.read().strip())
-                self.opacity_slider.blockSignals(True)
-                self.opacity_slider.setValue(value)
-                self.set_gif_opacity(value)
-                self.opacity_slider.blockSignals(False)
-            print(f"Загружено значение: {value} из {OPACITY_FILE}")
-        except FileNotFoundError:
-            print("Файл не найден, устанавливаем значение по умолчанию")
-        except ValueError:
-            print("Неверное значение в файле")
+        value = self.settings.get('opacity')
+        if value is None:
+            log.debug("Прозрачность не задана, устанавливаем значение по умолчанию")
+            return
+        self.opacity_slider.blockSignals(True)
+        self.opacity_slider.setValue(value)
+        self.set_gif_opacity(value)
+        self.opacity_slider.blockSignals(False)
+        log.debug("Загружено значение прозрачности: %s", value)
 
     def set_gif_opacity(self, value):
-        opacity_effect = QGraphicsOpacityEffect()
-        opacity_effect.setOpacity(value / 100)
-        self.gif_label.setGraphicsEffect(opacity_effect)
-        print(f"Применено значение прозрачности: {value}")
+        self.gif_view.set_opacity(value / 100)
+        log.debug("Применено значение прозрачности: %s", value)
 
     def on_opacity_slider_changed(self, value):
-        print(f"Изменение ползунка до: {value}")
+        log.debug("Изменение ползунка до: %s", value)
         self.set_gif_opacity(value)
         self.save_opacity(value)
-        print(f"Сохранено новое значение: {value}")
 
 
-    def update_gif_size(self):
-        if self.gif_movie:
-            self.gif_movie.setScaledSize(QSize(self.width() + 10, self.height() + 10))  # Гифка чуть больше размера окна
-            self.gif_movie.start()
+    def gif_frame_size(self):
+        return QSize(self.width() + 10, self.height() + 10)  # Гифка чуть больше размера окна
 
-    def animate_resize(self):
-        if self.target_size:
-            current_width = self.width()
-            current_height = self.height()
-            target_width, target_height = self.target_size
-
-            if current_width != target_width or current_height != target_height:
-                step_width = (target_width - current_width) // max(1, abs(target_width - current_width))
-                step_height = (target_height - current_height) // max(1, abs(target_height - current_height))
-
-                new_width = current_width + step_width
-                new_height = current_height + step_height
-
-                self.setUpdatesEnabled(False)
-                self.resize(new_width, new_height)
-                if self.gif_movie:
-                    self.gif_movie.setScaledSize(QSize(new_width + 10, new_height + 10))  # Гифка на 10px больше окна
-                    self.gif_movie.start()
-                self.setUpdatesEnabled(True)
-                self.repaint()
-            else:
-                self.resize_timer.stop()
-                self.save_window_size_and_position()
-                if self.gif_movie:
-                    self.gif_movie.setScaledSize(self.size())
-                    self.gif_movie.start()
+    def update_gif_size(self):
+        # Кадры под этот размер берутся из кэша; если их там нет, сразу играет ближайший
+        # уровень mipmap, а точный пересчет откладывается, пока размер меняется
+        if not self.gif_player.set_size(self.gif_frame_size(), approximate=True):
+            self.exact_size_timer.start()
+        self.gif_player.start()
+
+    def start_exact_scale(self):
+        if self.scale_thread is not None:
+            self.exact_size_timer.start()  # Дождемся предыдущего пересчета
+            return
+        if self.gif_player.tier is None:
+            return
+        thread = ScaleThread(self.gif_player.gif_path, self.frame_cache, self.gif_frame_size(), self)
+        thread.finished.connect(self.on_exact_scaled)
+        self.scale_thread = thread
+        thread.start()
+
+    def on_exact_scaled(self):
+        if self.sender() is not self.scale_thread:
+            return  # Окно закрыто, поток удалит менеджер
+        thread, self.scale_thread = self.scale_thread, None
+        thread.deleteLater()
+        # Пока считали, могли сменить гифку или размер: тогда результат не нужен
+        if thread.frames is None or thread.gif_path != self.gif_player.gif_path or \
+                thread.size != self.gif_frame_size() or self.gif_player.tier is None:
+            return
+        self.frame_cache.insert(thread.frames, user=self.gif_player)
+        self.gif_player.set_size(thread.size)
 
 
     def showContextMenu(self, pos):
-        print("showContextMenu called")
+        log.debug("showContextMenu called")
         if self.option_popup.isVisible():
-            print("Menu is visible, calling fade_out")
+            log.debug("Menu is visible, calling fade_out")
             self.option_popup.fade_out()
         else:
-            print("Menu is not visible, calling fade_in")
+            log.debug("Menu is not visible, calling fade_in")
             screen_geometry = QDesktopWidget().screenGeometry()
             center_x = (screen_geometry.width() - self.option_popup.width()) // 2
             center_y = (screen_geometry.height() - self.option_popup.height()) // 2
@@ -416,18 +2895,12 @@ class TransparentWindow(QMainWindow):
 
 
 
-    def create_mask(self):
-        path = QPainterPath()
-        radius = 20
-        path.addRoundedRect(0, 0, self.width(), self.height(), radius, radius)
-        region = QRegion(path.toFillPolygon().toPolygon())
-        return region
-
     def resizeEvent(self, event):
         super().resizeEvent(event)
-        self.setMask(self.create_mask())
-        self.gif_label.setGeometry(0, 0, self.width(), self.height())
-        self.update_gif_size()
+        self.gif_view.setGeometry(0, 0, self.width(), self.height())
+        # Во время анимации размера кадры пересчитываются один раз в конце
+        if not self.resize_timer.isActive():
+            self.update_gif_size()
 
     def moveEvent(self, event):
         super().moveEvent(event)
@@ -442,98 +2915,12 @@ class TransparentWindow(QMainWindow):
         if self.moving_mode and event.buttons() == Qt.LeftButton:
             self.move(event.globalPos() - self.start_pos)
             event.accept()
-    def load_window_size_and_position(self):
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                size_position = f.read().split()
-                if len(size_position) == 4:
-                    width, height, x, y = map(int, size_position)
-                    self.resize(width, height)
-                    self.move(x, y)
-    def load_last_gif_path(self):
-       if os.path.exists(LAST_GIF_FILE):
-            with open(LAST_GIF_FILE, 'r') as f:
-                gif_path = f.read()
-                if os.path.exists(gif_path):
-                    self.gif_movie = QMovie(gif_path)
-                    self.gif_label.setMovie(self.gif_movie)
-                     
-    def toggle_move_mode(self):
-        self.moving_mode = not self.moving_mode
-        self.update_move_button_text()
 
-    def update_move_button_text(self):
-        move_button_text = "Перемещение: ВКЛ." if self.moving_mode else "Перемещение: ВЫКЛ."
-        self.option_popup.move_button.setText(move_button_text)
-    def change_size(self):
-        dialog = SizeInputDialog(self.width(), self.height(), self)
-        if dialog.exec_() == QDialog.Accepted:
-            width, height = dialog.get_values()
-            if width and height:
-                self.target_size = (width, height)
-                self.resize_timer.start(10)  # Интервал в миллисекундах
-    def change_gif(self):
-        dialog = GifUrlInputDialog(self)
-        if dialog.exec_() == QDialog.Accepted:
-            gif_url = dialog.get_value()
-            if gif_url:
-                self.set_gif_from_url(gif_url)
-
-    def restart_application(self):
-        try:
-            executable = sys.executable if hasattr(sys, 'frozen') else sys.argv[0]
-            task_name = "Kiwi_Widget_Restart"
-            
-            # Удаляем задание, если оно уже существует
-            subprocess.call(['schtasks', '/delete', '/tn', task_name, '/f'])
-            
-            # Создаем новое задание на перезапуск
-            subprocess.call([
-                'schtasks', '/create', '/tn', task_name, '/tr', f'"{executable} {os.path.abspath(sys.argv[0])}"',
-                '/sc', 'once', '/st', '00:00', '/sd', '01/01/1990', '/f'
-            ])
-            
-            # Запускаем задание
-            subprocess.call(['schtasks', '/run', '/tn', task_name])
-            
-            QApplication.quit()
-        except Exception as e:
-            print(f"Ошибка при перезапуске: {e}")
-
-
-
-
-
-
-    def load_autostart(self):
-        return os.path.exists(AUTOSTART_PATH) or self.autostart_windows_exists()
-
-    def autostart_windows_exists(self):
-        autostart_key = r"Software\Microsoft\Windows\CurrentVersion\Run"
-        app_name = "Kiwi Widget"
-        try:
-            with winreg.OpenKey(winreg.HKEY_CURRENT_USER, autostart_key, 0, winreg.KEY_READ) as key:
-                winreg.QueryValueEx(key, app_name)
-                return True
-        except FileNotFoundError:
-            return False
-        except Exception as e:
-            print(f"Ошибка при проверке автозапуска в реестре: {e}")
-            return False
-
-    def toggle_autostart(self, state):
-        if state == Qt.Checked:
-            create_autostart_file()
-            create_autostart_windows()
-        else:
-            remove_autostart_file()
-            remove_autostart_windows()
-
-
-
-    def save_window_size_and_position(self):
-        with open(CONFIG_FILE, 'w') as f:
-            f.write(f"{self.width()} {self.height()} {self.x()} {self.y()}")
+    def mouseDoubleClickEvent(self, event):
+        # Двойной клик — следующая гифка плейлиста
+        if event.button() == Qt.LeftButton and not self.moving_mode and self.playlist.items:
+            self.playlist.next()
+            event.accept()
 
     def fade_in(self):
         self.setWindowOpacity(0)
@@ -541,7 +2928,7 @@ class TransparentWindow(QMainWindow):
         animation.setDuration(300)
         animation.setStartValue(0)
         animation.setEndValue(0.9)
-        animation.finished.connect(lambda: print("Animation complete: fade_in"))
+        animation.finished.connect(lambda: log.debug("Animation complete: fade_in"))
         animation.start()
         self.show()
 
@@ -550,7 +2937,7 @@ class TransparentWindow(QMainWindow):
         animation.setDuration(300)
         animation.setStartValue(0.9)
         animation.setEndValue(0)
-        animation.finished.connect(lambda: print("Animation complete: fade_out"))
+        animation.finished.connect(lambda: log.debug("Animation complete: fade_out"))
         animation.finished.connect(self.hide)
         animation.start()
 
@@ -572,41 +2959,8 @@ class TransparentWindow(QMainWindow):
         msg.setWindowTitle("Ошибка")
         msg.exec_()
         
-    def set_gif_from_url(self, url):
-        if not url.lower().endswith('.gif'):
-            self.show_error_message("Неверный формат ссылки. Пожалуйста, введите ссылку на GIF.")
-            return
-        
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            gif_path = os.path.join(GIF_FOLDER, f"custom_gif_{int(datetime.now().timestamp())}.gif")
-            with open(gif_path, 'wb') as f:
-                f.write(response.content)
-
-            self.gif_movie = QMovie(gif_path)
-            self.gif_label.setMovie(self.gif_movie)
-            self.gif_movie.setScaledSize(self.gif_label.size())
-            self.gif_movie.start()
-
-            self.save_last_gif_path(gif_path)
-        except requests.exceptions.RequestException:
-            self.show_error_message("Ссылка недоступна. Пожалуйста, введите действующую ссылку на GIF.")
-
-    def save_last_gif_path(self, gif_path):
-        with open(LAST_GIF_FILE, 'w') as f:
-            f.write(gif_path)
-
-
-    def set_opacity_effect(self, opacity):
-        effect = QGraphicsOpacityEffect(self)
-        effect.setOpacity(opacity)
-        return effect
-
-
-
     def contextMenuEvent(self, event):
-        print("contextMenuEvent called")
+        log.debug("contextMenuEvent called")
         if self.option_popup.isVisible():
             self.option_popup.fade_out()
         else:
@@ -621,146 +2975,258 @@ class TransparentWindow(QMainWindow):
         self.update_move_button_text()
 
     def update_move_button_text(self):
+        if self._option_popup is None:
+            return  # Текст выставится при создании окна параметров
         move_button_text = "Перемещение: ВКЛ." if self.moving_mode else "Перемещение: ВЫКЛ."
-        self.option_popup.move_button.setText(move_button_text)
+        self._option_popup.move_button.setText(move_button_text)
 
     def change_size(self):
         dialog = SizeInputDialog(self.width(), self.height(), self)
         if dialog.exec_() == QDialog.Accepted:
             width, height = dialog.get_values()
             if width and height:
-                self.target_size = (width, height)
-                self.resize_timer.start(10)  # Интервал в миллисекундах
+                self.start_resize_animation(width, height)
+
+    def start_resize_animation(self, width, height):
+        self.resize_start_size = (self.width(), self.height())
+        self.target_size = (width, height)
+        # Промежуточные кадры — уже отмасштабированный кадр, растянутый при отрисовке
+        self.gif_view.set_stretch(True)
+        self.resize_clock.start()
+        self.resize_timer.start(RESIZE_ANIMATION_INTERVAL)
 
     def animate_resize(self):
-        if self.target_size:
-            current_width = self.width()
-            current_height = self.height()
-            target_width, target_height = self.target_size
-
-            if current_width != target_width or current_height != target_height:
-                step_width = (target_width - current_width) // abs(target_width - current_width) if current_width != target_width else 0
-                step_height = (target_height - current_height) // abs(target_height - current_height) if current_height != target_height else 0
-
-                self.setUpdatesEnabled(False)  # Блокируем перерисовку
-                self.resize(current_width + step_width, current_height + step_height)
-                self.setUpdatesEnabled(True)  # Включаем перерисовку
-                self.repaint()  # Перерисовываем окно
-            else:
-                self.resize_timer.stop()
-                self.save_window_size_and_position()
-                if self.gif_movie:
-                    QTimer.singleShot(50, self.gif_movie.start)  # Запускаем GIF после завершения анимации
+        # Размер зависит от прошедшего времени, а не от числа шагов
+        progress = min(self.resize_clock.elapsed() / RESIZE_ANIMATION_DURATION, 1.0)
+        eased = self.resize_easing.valueForProgress(progress)
+        start_width, start_height = self.resize_start_size
+        target_width, target_height = self.target_size
+        self.resize(round(start_width + (target_width - start_width) * eased),
+                    round(start_height + (target_height - start_height) * eased))
+
+        if progress >= 1.0:
+            self.resize_timer.stop()
+            # Один точный пересчет кадров в конце анимации
+            self.gif_view.set_stretch(False)
+            self.update_gif_size()
+            self.save_window_size_and_position()
 
 
     def change_gif(self):
         dialog = GifUrlInputDialog(self)
-        if dialog.exec_() == QDialog.Accepted:
+        result = dialog.exec_()
+        if result == GifUrlInputDialog.Library:
+            self.choose_from_library()
+        elif result == QDialog.Accepted:
             gif_url = dialog.get_value()
             if gif_url:
                 self.set_gif_from_url(gif_url)
 
+    def choose_from_library(self):
+        dialog = GifLibraryDialog(self.gif_library, self.frame_cache, self.manager.clock, self)
+        accepted = dialog.exec_() == QDialog.Accepted
+        gif_path = dialog.get_value()
+        # Диалог держит превью и таймеры, а родитель — окно: без удаления каждое
+        # открытие библиотеки оставляло бы его в памяти до закрытия виджета
+        dialog.deleteLater()
+        if accepted and gif_path and not self.show_gif(gif_path):
+            self.show_error_message("Не удалось открыть гифку из библиотеки.")
+
     def set_gif_from_url(self, url):
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            gif_path = os.path.join(GIF_FOLDER, f"custom_gif_{int(datetime.now().timestamp())}.gif")
-            with open(gif_path, 'wb') as f:
-                f.write(response.content)
+        if self.download_thread is not None:
+            if self.download_thread.url == url:
+                return  # Эта ссылка уже качается
+            self.download_thread.cancel()
+            self.finish_gif_download()
+
+        # Эта ссылка уже есть в библиотеке — показываем сразу, а в фоне только
+        # спрашиваем сервер, не изменилась ли она
+        gif_path = self.gif_library.lookup_url(url)
+        if gif_path and self.show_gif(gif_path) and http_client().is_offline():
+            return
 
-            self.gif_movie = QMovie(gif_path)
-            self.gif_label.setMovie(self.gif_movie)
-            self.gif_movie.setScaledSize(self.gif_label.size())
-            self.gif_movie.start()
+        thread = GifDownloadThread(url, self.gif_library, self)
+        thread.progress.connect(self.on_gif_download_progress)
+        thread.downloaded.connect(self.on_gif_downloaded)
+        thread.failed.connect(self.on_gif_download_failed)
+        thread.finished.connect(thread.deleteLater)
+        self.download_thread = thread
+        thread.start()
 
-            self.save_last_gif_path(gif_path)
-        except Exception as e:
-            print(f"Ошибка загрузки GIF: {e}")
+    def show_gif(self, gif_path):
+        if not self.gif_player.load(gif_path, self.gif_frame_size()):
+            return False
+        self.gif_player.start()
+        self.gif_library.touch(gif_path)
+        self.save_last_gif_path(gif_path)
+        self.manager.live_reload.refresh()
+        return True
+
+    def edit_playlist(self):
+        dialog = PlaylistDialog(self.playlist.items, self.settings.get('playlist_interval') or 0, self)
+        if dialog.exec_() == QDialog.Accepted:
+            self.playlist.configure(*dialog.get_value())
+
+    def import_folder(self):
+        source = QFileDialog.getExistingDirectory(self, "Папка с гифками для импорта")
+        if source:
+            self.start_import(source)
+
+    def start_import(self, source, transcode=False, interactive=True):
+        if self.import_thread is not None:
+            raise ValueError("импорт уже идет")
+        thread = ImportThread(source, self.gif_library, transcode, self)
+        thread.interactive = interactive
+        # Только методы окна, без lambda: PyQt отключает их, когда окно удалено,
+        # а импорт может пережить окно (см. closeEvent)
+        thread.progress.connect(self.on_import_progress)
+        thread.done.connect(self.on_import_done)
+        thread.failed.connect(self.on_import_failed)
+        thread.finished.connect(thread.deleteLater)
+        self.import_thread = thread
+        thread.start()
+
+    def on_import_progress(self, finished, total):
+        if self.sender() is self.import_thread and self._option_popup is not None:
+            self._option_popup.import_button.setText(f"Импорт: {finished}/{total}")
+
+    def on_import_done(self, result):
+        if self.sender() is not self.import_thread:
+            return
+        interactive = self.import_thread.interactive
+        self.finish_import()
+        if interactive and not result['cancelled']:
+            msg = QMessageBox()
+            msg.setIcon(QMessageBox.Information)
+            msg.setText(f"Добавлено: {result['imported']}, уже было: {result['skipped']}, "
+                        f"пропущено: {len(result['failed'])}")
+            msg.setWindowTitle("Импорт")
+            msg.exec_()
+
+    def on_import_failed(self, error):
+        log.error("Ошибка импорта: %s", error)
+        if self.sender() is not self.import_thread:
+            return
+        interactive = self.import_thread.interactive
+        self.finish_import()
+        if interactive:
+            self.show_error_message(f"Не удалось импортировать: {error}")
+
+    def finish_import(self):
+        self.import_thread = None
+        if self._option_popup is not None:
+            self._option_popup.import_button.setText("Импорт папки")
+
+    def on_gif_download_progress(self, received, total):
+        if self.sender() is not self.download_thread or self._option_popup is None:
+            return
+        if total:
+            self.option_popup.change_gif_button.setText(f"Загрузка: {received * 100 // total}%")
+        else:
+            self.option_popup.change_gif_button.setText(f"Загрузка: {received // 1024} КБ")
+
+    def on_gif_downloaded(self, url, gif_path):
+        if self.sender() is not self.download_thread:
+            return
+        self.finish_gif_download()
+        if gif_path == self.gif_player.gif_path:
+            return  # Ссылка не изменилась, эта гифка уже на экране
+        # Подменяем гифку только когда файл полностью скачан
+        if not self.gif_player.load(gif_path, self.gif_frame_size()):
+            log.warning("Не удалось декодировать GIF: %s", gif_path)
+            self.gif_library.remove(gif_path)
+            self.show_error_message("Неверный формат файла. Пожалуйста, введите ссылку на GIF.")
+            return
+        self.gif_player.start()
+        self.save_last_gif_path(gif_path)
+        self.manager.live_reload.refresh()
+
+    def on_gif_download_failed(self, url, error):
+        if self.sender() is not self.download_thread:
+            return
+        self.finish_gif_download()
+        log.error("Ошибка загрузки GIF: %s", error)
+        self.show_error_message("Ссылка недоступна. Пожалуйста, введите действующую ссылку на GIF.")
+
+    def finish_gif_download(self):
+        self.download_thread = None
+        if self._option_popup is not None:
+            self._option_popup.change_gif_button.setText("Изменить GIF")
+
+    def closeEvent(self, event):
+        # Не ждем фоновые потоки в GUI-потоке: загрузка замечает отмену только между
+        # кусками, аватарку не отменить, а импорт при мягком перезапуске должен
+        # продолжиться. Живые потоки переходят к менеджеру и доживают без окна
+        for thread in self.findChildren(QThread):
+            if isinstance(thread, (GifDownloadThread, PrefetchThread)) or \
+                    (isinstance(thread, ImportThread) and not self.manager.restarting):
+                thread.cancel()
+            self.manager.adopt_thread(thread)
+        self.download_thread = self.import_thread = self.scale_thread = None
+        self.gif_player.release()
+        self.manager.remove_widget(self)
+        self.settings.flush()
+        super().closeEvent(event)
 
     def save_window_size_and_position(self):
-        with open(CONFIG_FILE, 'w') as f:
-            f.write(f"{self.width()} {self.height()} {self.x()} {self.y()}")
+        # Во время перетаскивания только обновляем значение в памяти
+        self.settings.set('geometry', [self.width(), self.height(), self.x(), self.y()])
 
     def load_window_size_and_position(self):
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                size_position = f.read().split()
-                if len(size_position) == 4:
-                    width, height, x, y = map(int, size_position)
-                    self.resize(width, height)
-                    self.move(x, y)
-
+        geometry = self.settings.get('geometry')
+        if geometry and len(geometry) == 4:
+            width, height, x, y = geometry
+            self.resize(width, height)
+            self.move(x, y)
 
     def save_last_gif_path(self, gif_path):
-        with open(LAST_GIF_FILE, 'w') as f:
-            f.write(gif_path)
+        self.settings.set('last_gif', gif_path)
+        self.gif_library.prepare_frame_store(gif_path)
 
     def load_last_gif_path(self):
-        if os.path.exists(LAST_GIF_FILE):
-            with open(LAST_GIF_FILE, 'r') as f:
-                gif_path = f.read()
-                if os.path.exists(gif_path):
-                    self.gif_movie = QMovie(gif_path)
-                    self.gif_label.setMovie(self.gif_movie)
+        gif_path = self.settings.get('last_gif')
+        if gif_path and os.path.exists(gif_path):
+            self.gif_player.load(gif_path, self.gif_frame_size())
+            self.gif_library.prepare_frame_store(gif_path)
+            self.manager.live_reload.refresh()
+
+    def apply_external_settings(self, keys):
+        # Настройки виджета поменяли снаружи: применяем только изменившиеся ключи
+        if 'geometry' in keys:
+            self.load_window_size_and_position()
+        if 'opacity' in keys and self.settings.get('opacity') is not None:
+            self.set_opacity_value(self.settings.get('opacity'))
+        if 'last_gif' in keys:
+            gif_path = self.settings.get('last_gif')
+            if gif_path != self.gif_player.gif_path and gif_path and os.path.exists(gif_path):
+                self.show_gif(gif_path)
+        if 'playlist' in keys or 'playlist_interval' in keys:
+            self.playlist.configure(self.settings.get('playlist') or [], self.settings.get('playlist_interval') or 0)
+
+    def set_opacity_value(self, value):
+        value = min(max(int(value), 30), 100)
+        self.opacity_slider.setValue(value)
+        if self._option_popup is not None:
+            slider = self._option_popup.opacity_slider
+            slider.blockSignals(True)
+            slider.setValue(value)
+            slider.blockSignals(False)
+        return value
 
     def restart_application(self):
-        try:
-            executable = sys.executable if hasattr(sys, 'frozen') else sys.argv[0]
-            if hasattr(sys, 'frozen'):
-                executable = os.path.abspath(sys.executable)
-            else:
-                executable = os.path.abspath(sys.argv[0])
-    
-            task_name = "Kiwi_Widget_Restart"
-    
-            # Удаляем задание, если оно уже существует
-            subprocess.call(['schtasks', '/delete', '/tn', task_name, '/f'])
-
-            # Создаем новое задание на перезапуск
-            subprocess.call([
-                'schtasks', '/create', '/tn', task_name, '/tr', f'"{executable}"',
-                '/sc', 'once', '/st', (datetime.now() + timedelta(seconds=10)).strftime("%H:%M"), '/f'
-            ])
-
-            # Запускаем задание
-            subprocess.call(['schtasks', '/run', '/tn', task_name])
-        
-            QApplication.quit()
-        except Exception as e:
-            print(f"Ошибка при перезапуске: {e}")
-
+        # Мягкий перезапуск в том же процессе; откладываем, чтобы меню успело закрыться
+        QTimer.singleShot(0, self.manager.soft_restart)
 
     def toggle_autostart(self, state):
-        if state == Qt.Checked:
-            create_autostart_file()
-            create_autostart_windows()
-        else:
-            remove_autostart_file()
-            remove_autostart_windows()
-
-    def load_autostart(self):
-        return os.path.exists(AUTOSTART_PATH) or self.autostart_windows_exists()
-
-    def autostart_windows_exists(self):
-        autostart_key = r"Software\Microsoft\Windows\CurrentVersion\Run"
-        app_name = "Kiwi Widget"
-        try:
-            with winreg.OpenKey(winreg.HKEY_CURRENT_USER, autostart_key, 0, winreg.KEY_READ) as key:
-                winreg.QueryValueEx(key, app_name)
-                return True
-        except FileNotFoundError:
-            return False
-        except Exception as e:
-            print(f"Ошибка при проверке автозапуска в реестре: {e}")
-            return False
+        self.manager.set_autostart(state == Qt.Checked)
 
     def showContextMenu(self, pos):
-        print("showContextMenu called")
+        log.debug("showContextMenu called")
         if self.option_popup.isVisible():
-            print("Menu is visible, calling fade_out")
+            log.debug("Menu is visible, calling fade_out")
             self.option_popup.fade_out()
         else:
-            print("Menu is not visible, calling fade_in")
+            log.debug("Menu is not visible, calling fade_in")
             screen_geometry = QDesktopWidget().screenGeometry()
             center_x = (screen_geometry.width() - self.option_popup.width()) // 2
             center_y = (screen_geometry.height() - self.option_popup.height()) // 2
@@ -770,6 +3236,450 @@ class TransparentWindow(QMainWindow):
 
 
 
+def ipc_address():
+    # Windows: имя именованного канала; остальные системы: путь к unix-сокету
+    if sys.platform == 'win32':
+        return IPC_SERVER_NAME
+    return os.path.join(tempfile.gettempdir(), IPC_SERVER_NAME)
+
+
+def send_command(command, args=(), widget=0, timeout=IPC_TIMEOUT):
+    # Отправляет команду запущенному экземпляру; None, если его нет. Экземпляр,
+    # который принял соединение, но не ответил вовремя (GUI-поток занят), запущен
+    socket = QLocalSocket()
+    socket.connectToServer(ipc_address())
+    if not socket.waitForConnected(timeout):
+        return None
+    request = {'command': command, 'args': list(args), 'widget': widget}
+    socket.write((json.dumps(request, ensure_ascii=False) + '\n').encode('utf-8'))
+    socket.waitForBytesWritten(timeout)
+    while not socket.canReadLine():
+        if not socket.waitForReadyRead(timeout):
+            return {'ok': False, 'error': "Нет ответа"}
+    reply = json.loads(bytes(socket.readLine()).decode('utf-8'))
+    socket.disconnectFromServer()
+    return reply
+
+
+class ControlServer(QObject):
+    # Локальный сервер команд: второй запуск и kiwi_ctl.py управляют уже запущенным
+    # процессом. Запрос и ответ — по одной JSON-строке:
+    #   {"command": "resize", "args": [400, 300], "widget": 0} -> {"ok": true, ...}
+    def __init__(self, manager, parent=None):
+        super().__init__(parent)
+        self.manager = manager
+        self.server = QLocalServer(self)
+        self.server.setSocketOptions(QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self.on_new_connection)
+
+    def listen(self):
+        # С UserAccessOption listen() молча подменяет существующий сокет, поэтому сначала
+        # проверяем, принимает ли его кто-то: занятый экземпляр может не успеть ответить,
+        # но соединение принимает. Удаляем только сокет, оставшийся после аварийного выхода
+        probe = QLocalSocket()
+        probe.connectToServer(ipc_address())
+        if probe.waitForConnected(IPC_TIMEOUT):
+            probe.disconnectFromServer()
+            log.error("Сервер команд уже занят другим экземпляром")
+            return
+        QLocalServer.removeServer(ipc_address())
+        if not self.server.listen(ipc_address()):
+            log.error("Не удалось запустить сервер команд: %s", self.server.errorString())
+
+    def on_new_connection(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            socket.readyRead.connect(lambda socket=socket: self.on_ready_read(socket))
+            socket.disconnected.connect(socket.deleteLater)
+
+    def on_ready_read(self, socket):
+        while socket.canReadLine():
+            reply = self.handle(bytes(socket.readLine()).decode('utf-8', 'replace'))
+            socket.write((json.dumps(reply, ensure_ascii=False) + '\n').encode('utf-8'))
+            socket.flush()
+
+    def handle(self, line):
+        try:
+            request = json.loads(line)
+            command = str(request['command'])
+            args = list(request.get('args', []))
+            index = int(request.get('widget', 0))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return {'ok': False, 'error': "Неверный запрос"}
+        handler = getattr(self, 'command_' + command.replace('-', '_'), None)
+        if handler is None:
+            return {'ok': False, 'error': f"Неизвестная команда: {command}"}
+        if not 0 <= index < len(self.manager.windows):
+            return {'ok': False, 'error': f"Нет виджета {index}"}
+        log.debug("Команда %s %s для виджета %s", command, args, index)
+        try:
+            result = handler(self.manager.windows[index], *args)
+        except (TypeError, ValueError) as e:
+            return {'ok': False, 'error': f"Неверные аргументы {command}: {e}"}
+        except Exception as e:
+            # Исключение из слота Qt завершило бы весь процесс, поэтому любая ошибка — только ответ
+            log.exception("Ошибка команды %s", command)
+            return {'ok': False, 'error': f"Ошибка {command}: {e}"}
+        return dict(result or {}, ok=True)
+
+    @staticmethod
+    def _int_arg(value, low, high, name):
+        value = int(value)
+        if not low <= value <= high:
+            raise ValueError(f"{name} вне диапазона {low}..{high}")
+        return value
+
+    def command_show(self, window):
+        for each in self.manager.windows:
+            each.show()
+            each.raise_()
+            each.activateWindow()
+
+    def command_set_gif(self, window, source):
+        source = str(source)
+        if is_url(source):
+            window.set_gif_from_url(source)  # Загрузка идет в фоне, как из диалога
+            return {'downloading': window.download_thread is not None}
+        path = os.path.abspath(os.path.expanduser(source))
+        if not window.show_gif(path):
+            raise ValueError(f"не удалось открыть {path}")
+
+    def command_resize(self, window, width, height):
+        width = self._int_arg(width, 1, IPC_MAX_COORDINATE, "ширина")
+        height = self._int_arg(height, 1, IPC_MAX_COORDINATE, "высота")
+        window.start_resize_animation(width, height)
+
+    def command_move(self, window, x, y):
+        window.move(self._int_arg(x, -IPC_MAX_COORDINATE, IPC_MAX_COORDINATE, "x"),
+                    self._int_arg(y, -IPC_MAX_COORDINATE, IPC_MAX_COORDINATE, "y"))
+
+    def command_opacity(self, window, value):
+        return {'opacity': window.set_opacity_value(self._int_arg(value, 0, 100, "прозрачность"))}
+
+    def command_pause(self, window):
+        window.playback_scheduler.set_user_paused(True)
+
+    def command_resume(self, window):
+        window.playback_scheduler.set_user_paused(False)
+
+    def command_next(self, window):
+        window.playlist.next()
+
+    def command_restart(self, window):
+        QTimer.singleShot(0, self.manager.soft_restart)  # Сначала ответ, потом пересоздание окон
+
+    def command_import(self, window, source, transcode=False):
+        # Импорт идет в фоне; ход виден в query-stats
+        path = os.path.abspath(os.path.expanduser(str(source)))
+        if not os.path.exists(path):
+            raise ValueError(f"нет такого пути: {path}")
+        window.start_import(path, bool(transcode), interactive=False)
+        return {'importing': path}
+
+    def command_query_stats(self, window):
+        imports = [{'widget': index, 'source': each.import_thread.source,
+                    'finished': each.import_thread.finished_count, 'total': each.import_thread.total}
+                   for index, each in enumerate(self.manager.windows) if each.import_thread is not None]
+        widgets = []
+        for index, each in enumerate(self.manager.windows):
+            player = each.gif_player
+            widgets.append({
+                'widget': index,
+                'gif': player.gif_path,
+                'geometry': [each.width(), each.height(), each.x(), each.y()],
+                'opacity': round(each.gif_view.opacity * 100),  # Как нарисовано, а не скрытый ползунок
+                'paused': player.paused,
+                'user_paused': each.playback_scheduler.user_paused,
+                'frames': len(player.delays),
+                'streaming': player.stream is not None,
+                'playlist': len(each.playlist.items),
+            })
+        return {
+            'widgets': widgets,
+            'rss_kb': current_rss_kb(),
+            'frame_memory': self.manager.frame_cache.memory_usage(),
+            'imports': imports,
+            'first_paint_ms': self.manager.windows[0].first_paint_ms,
+            'metrics': self.manager.last_metrics,
+        }
+
+
+class LiveReload(QObject):
+    # Следит через QFileSystemWatcher (inotify и аналоги, без опроса) за файлом
+    # настроек, старыми файлами настроек и показанными гифками. Изменения снаружи
+    # (скрипт, синхронизация) копятся и применяются через LIVE_RELOAD_DELAY после
+    # последнего события, и только то, что поменялось
+    def __init__(self, manager):
+        super().__init__(manager)
+        self.manager = manager
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.on_changed)
+        self.watcher.directoryChanged.connect(self.on_changed)
+        self.pending = set()
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(LIVE_RELOAD_DELAY)
+        self.timer.timeout.connect(self.apply)
+
+    def wanted_files(self):
+        paths = {self.manager.settings.path, *LEGACY_SETTINGS_KEYS}
+        paths.update(window.gif_player.gif_path for window in self.manager.windows)
+        return {path for path in paths if path and os.path.isfile(path)}
+
+    def refresh(self):
+        # Приводит список наблюдаемых путей к текущему; папки нужны, чтобы заметить
+        # файлы, созданные заново или замененные переименованием
+        files = self.wanted_files()
+        directories = {os.path.dirname(path) for path in files} | {DOCUMENTS_DIR}
+        for wanted, watched in ((files, set(self.watcher.files())),
+                                (directories, set(self.watcher.directories()))):
+            if watched - wanted:
+                self.watcher.removePaths(list(watched - wanted))
+            added = [path for path in wanted - watched if os.path.exists(path)]
+            if added:
+                self.watcher.addPaths(added)
+
+    def on_changed(self, path):
+        self.pending.add(path)
+        self.timer.start()  # Каждое событие откладывает применение
+
+    def apply(self):
+        pending, self.pending = self.pending, set()
+        watched = set(self.watcher.files())
+        # Измененные файлы и файлы, которые пропали из наблюдения (удалены и созданы заново)
+        changed = {path for path in self.wanted_files() if path in pending or path not in watched}
+        self.refresh()
+        settings_path = self.manager.settings.path
+        if settings_path in changed:
+            self.manager.reload_settings()
+        for path in changed:
+            if path in LEGACY_SETTINGS_KEYS and path != settings_path:
+                self.manager.apply_legacy_setting(path)
+        gifs = changed - {settings_path} - set(LEGACY_SETTINGS_KEYS)
+        if gifs:
+            self.manager.reload_gifs(gifs)
+
+
+class WidgetManager(QObject):
+    # Хозяин всех виджетов процесса: общий файл настроек, кэш кадров, часы
+    # анимации и библиотека GIF. Память и CPU растут с числом разных гифок, а не окон
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # Настройки читаются один раз и сбрасываются на диск при выходе
+        self.settings = SettingsStore(parent=self)
+        self.settings.externalChanged.connect(self.apply_external_changes)
+        QApplication.instance().aboutToQuit.connect(self.settings.flush)
+        QApplication.instance().aboutToQuit.connect(self.finish_threads)
+        self.frame_cache = FrameCache(decode_budget_mb=self.settings.get('decode_budget_mb'),
+                                      lookahead=self.settings.get('stream_lookahead'),
+                                      memory_budget_mb=self.settings.get('memory_budget_mb'))
+        self.clock = AnimationClock(self)
+        self.windows = []
+        self.gif_library = GifLibrary(protected_paths=self.protected_gif_paths)
+        QApplication.instance().aboutToQuit.connect(self.gif_library.flush)
+        if self.gif_library.needs_migration:
+            threading.Thread(target=self.gif_library.migrate, daemon=True).start()
+        self.started = STARTUP_TIME  # От этого момента считается время до первого кадра окна
+        self.restarting = False
+        self.control_server = None
+        self.last_metrics = None  # Последний снимок метрик, его отдает query-stats
+        self.live_reload = LiveReload(self)  # Пути добавятся, когда окна покажут гифки
+        # Запись автозапуска в системе меняем только при смене настройки, а не при
+        # каждом расхождении: ее могли включить или выключить в самой системе
+        self.autostart = bool(self.settings.get('autostart'))
+
+        # Метрики включаются в настройках: оверлей поверх гифки и/или файл metrics.json
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.setInterval(METRICS_INTERVAL)
+        self.metrics_timer.timeout.connect(self.update_metrics)
+        self.set_metrics(self.settings.get('metrics_overlay'), self.settings.get('metrics_dump'))
+
+    def start_control_server(self):
+        self.control_server = ControlServer(self, self)
+        self.control_server.listen()
+
+    def adopt_thread(self, thread):
+        # Поток закрытого окна: удалится сам, когда закончит
+        if thread.isFinished():
+            return
+        thread.setParent(self)
+        thread.finished.connect(thread.deleteLater)
+
+    def finish_threads(self):
+        # При выходе дожидаемся потоков закрытых окон, чтобы не уничтожить живой QThread
+        for thread in self.findChildren(QThread):
+            if isinstance(thread, (GifDownloadThread, PrefetchThread, ImportThread)):
+                thread.cancel()
+            thread.wait()
+
+    def protected_gif_paths(self):
+        # Вызывается и из потока переноса библиотеки, возможно до того, как окна созданы,
+        # поэтому кроме открытых окон защищаем все, на что ссылаются настройки виджетов
+        paths = set()
+        for widget in list(self.settings.values['widgets']):
+            paths.add(widget.get('last_gif'))
+            paths.update(item for item in list(widget.get('playlist') or []) if not is_url(item))
+        for window in list(self.windows):
+            paths.add(window.settings.get('last_gif'))
+            paths.add(window.gif_player.gif_path)
+            paths.add(window.playlist.prefetched_path())
+        return paths
+
+    def restore(self):
+        # Поднимает все виджеты, сохраненные в настройках
+        count = max(len(self.settings.get('widgets')), 1)
+        for index in range(count):
+            TransparentWindow(self.settings.widget_settings(index)).show()
+        self.live_reload.refresh()
+
+    def add_widget(self, values=None):
+        self.started = time.perf_counter()
+        window = TransparentWindow(self.settings.add_widget(values))
+        window.setAttribute(Qt.WA_DeleteOnClose)
+        return window
+
+    def remove_widget(self, window):
+        if window in self.windows:
+            self.windows.remove(window)
+        # Последний виджет остается в настройках, чтобы появиться при следующем запуске
+        if self.windows and not self.restarting:
+            self.settings.remove_widget(window.settings)
+        self.live_reload.refresh()
+
+    def soft_restart(self):
+        # Перезапуск без нового процесса: настройки перечитываются с диска, окна и меню
+        # создаются заново, а кэш кадров, часы и библиотека остаются прогретыми
+        self.started = time.perf_counter()
+        old_windows = list(self.windows)
+        self.settings.flush()
+        self.settings.reload()
+        self.apply_settings()
+        # Новые окна показываем до закрытия старых, иначе Qt завершит приложение
+        self.restore()
+        self.restarting = True
+        try:
+            for window in old_windows:
+                window.setAttribute(Qt.WA_DeleteOnClose)
+                window.close()
+        finally:
+            self.restarting = False
+        log.info("Мягкий перезапуск за %.0f мс", (time.perf_counter() - self.started) * 1000)
+
+    def apply_settings(self):
+        # Общие настройки из self.settings: автозапуск, кэш кадров, FPS и метрики
+        self.set_autostart(self.settings.get('autostart'))
+        self.frame_cache.decode_budget = self.settings.get('decode_budget_mb') * 1024 * 1024
+        self.frame_cache.lookahead = self.settings.get('stream_lookahead')
+        self.frame_cache.set_memory_budget(self.settings.get('memory_budget_mb'))
+        for window in self.windows:
+            window.gif_player.set_fps_cap(self.settings.get('fps_cap'))
+        overlay, dump = bool(self.settings.get('metrics_overlay')), bool(self.settings.get('metrics_dump'))
+        if (overlay, dump) != (self.metrics_overlay, self.metrics_dump):
+            self.set_metrics(overlay, dump)
+
+    def set_autostart(self, enabled):
+        enabled = bool(enabled)
+        if enabled != self.autostart:
+            apply_autostart(enabled)
+            self.autostart = enabled
+        self.settings.set('autostart', enabled)
+
+    def reload_settings(self):
+        # Файл настроек изменили снаружи
+        changes = self.settings.external_changes()
+        if changes is not None:
+            self.apply_external_changes(changes)
+
+    def apply_external_changes(self, changes):
+        root, widgets = changes
+        if widgets is None:
+            log.info("Набор виджетов в настройках изменился, пересоздаем окна")
+            self.soft_restart()
+            return
+        if root:
+            log.info("Настройки изменены снаружи: %s", ", ".join(sorted(root)))
+            self.apply_settings()
+        for values, keys in widgets:
+            for window in self.windows:
+                if window.settings.values is values:
+                    log.info("Настройки виджета изменены снаружи: %s", ", ".join(sorted(keys)))
+                    window.apply_external_settings(keys)
+
+    def apply_legacy_setting(self, path):
+        # Старый файл настроек относится к единственному виджету старых версий — первому
+        key = LEGACY_SETTINGS_KEYS[path]
+        value = read_legacy_settings().get(key)
+        if value is None or not self.windows:
+            return
+        log.info("Изменен %s, применяем %s", os.path.basename(path), key)
+        if key == 'autostart':
+            self.settings.set(key, value)
+            self.apply_settings()
+        else:
+            window = self.windows[0]
+            window.settings.set(key, value)
+            window.apply_external_settings({key})
+
+    def reload_gifs(self, paths):
+        # Показанный файл гифки перезаписали: у кэша кадров ключ с новым mtime, декодируем заново
+        for window in self.windows:
+            if window.gif_player.gif_path in paths:
+                log.info("Файл %s изменен, перезагружаем", window.gif_player.gif_path)
+                window.show_gif(window.gif_player.gif_path)
+
+    def set_metrics(self, overlay, dump):
+        self.metrics_overlay = bool(overlay)
+        self.metrics_dump = bool(dump)
+        metrics.enabled = self.metrics_overlay or self.metrics_dump
+        metrics.reset()
+        if metrics.enabled:
+            self.metrics_timer.start()
+        else:
+            self.metrics_timer.stop()
+            for window in self.windows:
+                window.gif_view.overlay_text = None
+                window.gif_view.update()
+
+    def update_metrics(self):
+        values = metrics.snapshot()
+        values['widgets'] = len(self.windows)
+        values['frame_memory'] = self.frame_cache.memory_usage()
+        self.last_metrics = values
+        if self.metrics_overlay:
+            hit_rate = values['cache_hit_rate']
+            overlay_text = "\n".join([
+                f"FPS: {values['fps']:.1f}",
+                f"Пропущено кадров: {values['dropped_frames']}",
+                f"Декодирование: {values['decode_ms']:.1f} мс",
+                f"Отрисовка: {values['blit_ms']:.2f} мс",
+                f"Кэш: {'-' if hit_rate is None else f'{hit_rate * 100:.0f}%'}",
+                f"Память: {values['rss_kb'] / 1024:.0f} МБ",
+                f"Кадры: {values['frame_memory']['used_mb']:.0f}/{values['frame_memory']['budget_mb']:.0f} МБ",
+            ])
+            for window in self.windows:
+                window.gif_view.overlay_text = overlay_text
+                window.gif_view.update()
+        if self.metrics_dump:
+            values['timestamp'] = time.time()
+            tmp_path = METRICS_FILE + '.tmp'
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(values, f)
+                os.replace(tmp_path, METRICS_FILE)
+            except OSError as e:
+                log.error("Ошибка записи метрик: %s", e)
+
+
+_widget_manager = None
+
+
+def widget_manager():
+    global _widget_manager
+    if _widget_manager is None:
+        _widget_manager = WidgetManager()
+    return _widget_manager
+
+
 class SizeInputDialog(QDialog):
     def __init__(self, current_width, current_height, parent=None):
         super().__init__(parent)
@@ -815,6 +3725,8 @@ class SizeInputDialog(QDialog):
         return width, height
 
 class GifUrlInputDialog(QDialog):
+    Library = 2  # Код результата: пользователь хочет выбрать гифку из библиотеки
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setWindowTitle("Изменить GIF")
@@ -822,9 +3734,11 @@ class GifUrlInputDialog(QDialog):
         layout = QVBoxLayout(self)
 
         self.gif_url_input = QLineEdit(self)
-        layout.addWidget(QLabel("Введите ссылку на GIF:"))
+        layout.addWidget(QLabel("Ссылка на GIF, WebP или APNG:"))
         layout.addWidget(self.gif_url_input)
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        library_button = button_box.addButton("Библиотека", QDialogButtonBox.ActionRole)
+        library_button.clicked.connect(lambda: self.done(self.Library))
         button_box.accepted.connect(self.accept)
         button_box.rejected.connect(self.reject)
         layout.addWidget(button_box)
@@ -855,8 +3769,304 @@ class GifUrlInputDialog(QDialog):
 
 
 
+class ThumbnailLoader(QObject):
+    # Читает превью из THUMBNAIL_FOLDER (или создает недостающие) в своем потоке.
+    # Запросы обслуживаются с конца: при быстрой прокрутке первыми грузятся строки,
+    # которые видны сейчас, а давно прокрученные вытесняются из очереди
+    loaded = pyqtSignal(str, QImage)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._requests = OrderedDict()  # digest -> путь к гифке
+        self._condition = threading.Condition()
+        self._closed = False
+        threading.Thread(target=self._run, name='kiwi-thumbnails', daemon=True).start()
+
+    def request(self, digest, gif_path):
+        with self._condition:
+            self._requests.pop(digest, None)
+            self._requests[digest] = gif_path
+            while len(self._requests) > THUMBNAIL_QUEUE_LIMIT:
+                self._requests.popitem(last=False)
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._requests.clear()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._requests and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                digest, gif_path = self._requests.popitem()
+            try:
+                image = QImage(write_thumbnail(gif_path, digest))
+            except (OSError, ValueError) as e:
+                log.warning("Нет превью для %s: %s", gif_path, e)
+                image = QImage()
+            with self._condition:
+                if self._closed:
+                    return  # Диалог закрыт, сигнал некуда доставлять
+                self.loaded.emit(digest, image)
+
+
+class GifLibraryModel(QAbstractListModel):
+    # Снимок библиотеки, недавно использованные первыми. Превью запрашиваются только
+    # из paint() делегата, то есть для видимых ячеек, и держатся в памяти LRU-кэшем
+    def __init__(self, library, parent=None):
+        super().__init__(parent)
+        with library._lock:
+            items = sorted(library.entries.items(), key=lambda item: -item[1]['last_used'])
+            self.items = [(digest, dict(entry), library.path_of(digest)) for digest, entry in items]
+        self.rows = {digest: row for row, (digest, _, _) in enumerate(self.items)}
+        self.thumbnails = OrderedDict()  # digest -> QPixmap (пустой, если превью не сделать)
+        self.loader = ThumbnailLoader(self)
+        self.loader.loaded.connect(self.on_loaded)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        digest, entry, path = self.items[index.row()]
+        if role == Qt.UserRole:
+            return path
+        if role == Qt.ToolTipRole:
+            duration = f"{entry['duration'] / 1000:.1f} с, " if entry.get('duration') else ''
+            return (f"{entry.get('width')}x{entry.get('height')}, кадров: {entry.get('frames')}, "
+                    f"{duration}{entry.get('size', 0) // 1024} КБ")
+        return None
+
+    def thumbnail(self, row):
+        digest, _, path = self.items[row]
+        pixmap = self.thumbnails.get(digest)
+        if pixmap is not None:
+            self.thumbnails.move_to_end(digest)
+            return pixmap
+        self.loader.request(digest, path)
+        return None
+
+    def on_loaded(self, digest, image):
+        row = self.rows.get(digest)
+        if row is None:
+            return
+        self.thumbnails[digest] = QPixmap.fromImage(image)
+        while len(self.thumbnails) > THUMBNAIL_MEMORY_ITEMS:
+            self.thumbnails.popitem(last=False)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
+class GifThumbnailDelegate(QStyledItemDelegate):
+    # Рисует превью ячейки; у ячейки под курсором — текущий кадр живой гифки
+    def __init__(self, dialog):
+        super().__init__(dialog)
+        self.dialog = dialog
+
+    def sizeHint(self, option, index):
+        return QSize(THUMBNAIL_SIZE + 12, THUMBNAIL_SIZE + 12)
+
+    def paint(self, painter, option, index):
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, QColor('#bbdefb'))
+        elif option.state & QStyle.State_MouseOver:
+            painter.fillRect(option.rect, QColor('#eeeeee'))
+        pixmap = self.dialog.hover_frame if index.row() == self.dialog.hover_row else None
+        if pixmap is None:
+            pixmap = index.model().thumbnail(index.row())
+        if pixmap is None or pixmap.isNull():
+            return  # Превью еще грузится
+        size = pixmap.size().scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.KeepAspectRatio)
+        x = option.rect.x() + (option.rect.width() - size.width()) // 2
+        y = option.rect.y() + (option.rect.height() - size.height()) // 2
+        painter.drawPixmap(QRect(x, y, size.width(), size.height()), pixmap)
+
+
+class GifLibraryDialog(QDialog):
+    # Выбор уже скачанной гифки из библиотеки. QListView с одинаковыми ячейками создает
+    # и рисует только видимые, поэтому десятки тысяч записей не тормозят. Анимируется
+    # только гифка под курсором: кадры готовятся в фоне (ScaleThread) и играют через
+    # общий FrameCache и часы
+    def __init__(self, library, frame_cache, clock, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Библиотека GIF")
+        self.resize(640, 480)
+        layout = QVBoxLayout(self)
+
+        self.model = GifLibraryModel(library, self)
+        self.view = QListView(self)
+        self.view.setViewMode(QListView.IconMode)
+        self.view.setMovement(QListView.Static)
+        self.view.setResizeMode(QListView.Adjust)
+        self.view.setUniformItemSizes(True)
+        self.view.setLayoutMode(QListView.Batched)
+        self.view.setSpacing(4)
+        self.view.setMouseTracking(True)
+        self.view.setItemDelegate(GifThumbnailDelegate(self))
+        self.view.setModel(self.model)
+        self.view.entered.connect(self.on_hover)
+        self.view.viewport().installEventFilter(self)
+        self.view.doubleClicked.connect(self.accept)
+        layout.addWidget(QLabel(f"Гифок в библиотеке: {len(self.model.items)}"))
+        layout.addWidget(self.view)
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        button_box.accepted.connect(self.accept)
+        button_box.rejected.connect(self.reject)
+        layout.addWidget(button_box)
+
+        self.hover_row = None
+        self.hover_frame = None
+        self.hover_thread = None
+        self.hover_player = GifPlayer(frame_cache, clock, self)
+        self.hover_player.frameChanged.connect(self.on_hover_frame)
+        self.hover_timer = QTimer(self)
+        self.hover_timer.setSingleShot(True)
+        self.hover_timer.setInterval(HOVER_ANIMATION_DELAY)
+        self.hover_timer.timeout.connect(self.start_hover_animation)
+
+        # Устанавливаем стили
+        self.setStyleSheet("""
+            QDialog, QListView {
+                background-color: white;
+            }
+            QLabel {
+                color: black;
+            }
+            QPushButton {
+                background-color: #2196f3;
+                color: white;
+                border: none;
+                border-radius: 10px;
+            }
+        """)
+
+    def eventFilter(self, watched, event):
+        if event.type() == QEvent.Leave:
+            self.stop_hover()
+        return super().eventFilter(watched, event)
+
+    def on_hover(self, index):
+        if index.row() == self.hover_row:
+            return
+        self.stop_hover()
+        self.hover_row = index.row()
+        self.hover_timer.start()
+
+    def start_hover_animation(self):
+        if self.hover_thread is not None:
+            self.hover_timer.start()  # Дождемся кадров предыдущей гифки
+            return
+        path = self.model.items[self.hover_row][2]
+        thread = ScaleThread(path, self.hover_player.frame_cache, self.hover_size(), self)
+        thread.finished.connect(self.on_hover_decoded)
+        self.hover_thread = thread
+        thread.start()
+
+    def hover_size(self):
+        entry = self.model.items[self.hover_row][1]
+        size = QSize(entry.get('width') or THUMBNAIL_SIZE, entry.get('height') or THUMBNAIL_SIZE)
+        return size.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.KeepAspectRatio).expandedTo(QSize(1, 1))
+
+    def on_hover_decoded(self):
+        thread, self.hover_thread = self.hover_thread, None
+        thread.deleteLater()
+        # Пока декодировали, курсор мог уйти на другую ячейку
+        if self.hover_row is None or self.model.items[self.hover_row][2] != thread.gif_path:
+            return
+        if thread.frames is not None:
+            self.hover_player.frame_cache.insert(thread.frames, user=self.hover_player)
+        if self.hover_player.load(thread.gif_path, thread.size):
+            self.hover_player.start()
+
+    def on_hover_frame(self, pixmap, rect):
+        if self.hover_row is None:
+            return
+        self.hover_frame = pixmap
+        self.view.viewport().update(self.view.visualRect(self.model.index(self.hover_row)))
+
+    def stop_hover(self):
+        self.hover_timer.stop()
+        self.hover_player.release()
+        self.hover_player.gif_path = None
+        if self.hover_row is not None:
+            row, self.hover_row, self.hover_frame = self.hover_row, None, None
+            self.view.viewport().update(self.view.visualRect(self.model.index(row)))
+
+    def done(self, result):
+        self.stop_hover()
+        self.model.loader.close()
+        if self.hover_thread is not None:
+            self.hover_thread.wait()
+        super().done(result)
+
+    def get_value(self):
+        index = self.view.currentIndex()
+        return self.model.data(index, Qt.UserRole) if index.isValid() else None
+
+
+class PlaylistDialog(QDialog):
+    def __init__(self, items, interval, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Плейлист")
+        self.setFixedSize(360, 320)
+        layout = QVBoxLayout(self)
+
+        self.items_input = QPlainTextEdit(self)
+        self.items_input.setPlainText("\n".join(items))
+        self.interval_input = QLineEdit(str(interval), self)
+        layout.addWidget(QLabel("Файлы и ссылки, по одному в строке:"))
+        layout.addWidget(self.items_input)
+        layout.addWidget(QLabel("Смена каждые N секунд (0 — по двойному клику):"))
+        layout.addWidget(self.interval_input)
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        button_box.accepted.connect(self.accept)
+        button_box.rejected.connect(self.reject)
+        layout.addWidget(button_box)
+
+        # Устанавливаем стили
+        self.setStyleSheet("""
+            QDialog {
+                background-color: white;
+            }
+            QLabel {
+                color: black;
+            }
+            QLineEdit, QPlainTextEdit {
+                color: black;
+                background-color: white;
+                border: 1px solid #ccc;
+            }
+            QPushButton {
+                background-color: #2196f3;
+                color: white;
+                border: none;
+                border-radius: 10px;
+            }
+        """)
+
+    def get_value(self):
+        items = [line.strip() for line in self.items_input.toPlainText().splitlines() if line.strip()]
+        try:
+            interval = max(int(self.interval_input.text()), 0)
+        except ValueError:
+            interval = 0
+        return items, interval
+
 if __name__ == '__main__':
+    # Уровень диагностики: KIWI_LOG_LEVEL=DEBUG/INFO/WARNING (по умолчанию WARNING)
+    logging.basicConfig(level=os.environ.get('KIWI_LOG_LEVEL', 'WARNING').upper(),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     app = QApplication(sys.argv)
-    window = TransparentWindow()
-    window.show()
+    # Уже запущен — показываем его окна вместо второго процесса Qt
+    if send_command('show') is not None:
+        log.info("Kiwi Widget уже запущен")
+        sys.exit(0)
+    widget_manager().restore()
+    widget_manager().start_control_server()
     sys.exit(app.exec_())
@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Бенчмарк Kiwi Widget без экрана: запускает TransparentWindow под
+# QT_QPA_PLATFORM=offscreen на сгенерированных GIF и пишет результаты в JSON.
+#
+#   python benchmark.py --output bench.json
+#   python benchmark.py --output new.json --compare bench.json
+
+DEFAULT_CASES = [
+    # (ширина, высота, кадров)
+    (320, 240, 30),
+    (800, 600, 60),
+    (1920, 1080, 20),
+]
+DEFAULT_RESIZE_DELTAS = [50, 200, 600]
+PLAYBACK_SECONDS = 3
+OPACITY_BURST_TICKS = 500
+WINDOW_SIZE = (400, 300)
+
+PALETTE_SIZE = 128  # 7 бит на пиксель: коды LZW помещаются ровно в байт
+LZW_CLEAR = PALETTE_SIZE
+LZW_END = PALETTE_SIZE + 1
+LZW_RUN = 120  # Пикселей между clear-кодами, чтобы ширина кода не выросла до 9 бит
+
+
+def _sub_blocks(data):
+    blocks = [bytes([len(data[i:i + 255])]) + data[i:i + 255] for i in range(0, len(data), 255)]
+    return b''.join(blocks) + b'\x00'
+
+
+def _lzw_uncompressed(pixels):
+    # "Несжатый" LZW: только литералы и регулярный сброс таблицы
+    runs = [bytes([LZW_CLEAR]) + pixels[i:i + LZW_RUN] for i in range(0, len(pixels), LZW_RUN)]
+    return b''.join(runs) + bytes([LZW_END])
+
+
+def write_test_gif(path, width, height, frames, delay_ms=40):
+    # Генерирует анимированный GIF без сторонних библиотек: сдвигающийся градиент
+    palette = b''.join(bytes([(i * 2) % 256, (i * 5) % 256, 255 - i * 2]) for i in range(PALETTE_SIZE))
+    base = bytes(range(PALETTE_SIZE)) * ((width + height + frames * 4) // PALETTE_SIZE + 2)
+    out = [
+        b'GIF89a',
+        width.to_bytes(2, 'little'), height.to_bytes(2, 'little'),
+        bytes([0xF6, 0, 0]),  # Глобальная палитра на 128 цветов
+        palette,
+        b'\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00',  # Бесконечный повтор
+    ]
+    for frame in range(frames):
+        pixels = b''.join(base[y + frame * 4:y + frame * 4 + width] for y in range(height))
+        out += [
+            b'\x21\xF9\x04\x04', (delay_ms // 10).to_bytes(2, 'little'), b'\x00\x00',
+            b'\x2C\x00\x00\x00\x00', width.to_bytes(2, 'little'), height.to_bytes(2, 'little'), b'\x00',
+            bytes([7]),  # Минимальный размер кода LZW
+            _sub_blocks(_lzw_uncompressed(pixels)),
+        ]
+    out.append(b'\x3B')
+    with open(path, 'wb') as f:
+        f.write(b''.join(out))
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run_for(app, seconds):
+    # Обычный цикл событий, как в приложении: без опроса, иначе он сам съедает CPU
+    from PyQt5.QtCore import QEventLoop, QTimer
+    loop = QEventLoop()
+    QTimer.singleShot(round(seconds * 1000), loop.quit)
+    loop.exec_()
+
+
+def run_case(gif_path, resize_deltas):
+    # Выполняется в отдельном процессе, чтобы пиковая память относилась к одному GIF
+    os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+    home = tempfile.mkdtemp(prefix='kiwi_bench_')
+    os.environ['HOME'] = os.environ['USERPROFILE'] = home
+    # Готовая аватарка, чтобы старт окна не ходил в сеть
+    documents_dir = os.path.join(home, 'Documents', 'Kiwi Widget')
+    os.makedirs(documents_dir)
+    open(os.path.join(documents_dir, 'avatar.png'), 'wb').close()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication([])
+    from PyQt5.QtCore import QEventLoop
+    import Kiwi_Widget
+
+    result = {'gif': os.path.basename(gif_path), 'file_size': os.path.getsize(gif_path)}
+
+    window = Kiwi_Widget.TransparentWindow()
+    window.resize(*WINDOW_SIZE)
+    window.show()
+    app.processEvents()
+    result['first_paint_ms'] = window.first_paint_ms
+
+    start = time.perf_counter()
+    window.gif_player.load(gif_path, window.gif_frame_size())
+    window.gif_player.start()
+    result['load_ms'] = (time.perf_counter() - start) * 1000
+
+    # Установившееся воспроизведение: процессорное время на секунду
+    run_for(app, 0.5)
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    run_for(app, PLAYBACK_SECONDS)
+    result['playback_cpu_per_second'] = (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+
+    resize_results = []
+    for delta in resize_deltas:
+        width, height = WINDOW_SIZE
+        window.resize(width, height)
+        app.processEvents()
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        window.start_resize_animation(width + delta, height + delta)
+        while window.resize_timer.isActive():
+            app.processEvents(QEventLoop.WaitForMoreEvents)
+        resize_results.append({
+            'delta': delta,
+            'total_ms': (time.perf_counter() - start) * 1000,
+            'cpu_ms': (time.process_time() - cpu_start) * 1000,
+        })
+    result['resize'] = resize_results
+
+    # Пачка тиков ползунка прозрачности, как при быстром перетаскивании
+    slider = window.option_popup.opacity_slider
+    start = time.perf_counter()
+    for tick in range(OPACITY_BURST_TICKS):
+        slider.setValue(30 + tick % 71)
+        app.processEvents()
+    result['opacity_burst_ms'] = (time.perf_counter() - start) * 1000
+    result['opacity_ticks'] = OPACITY_BURST_TICKS
+
+    # Пик памяти — только виджета: отдельные замеры загрузки и декодирования ниже его не трогают
+    result['peak_rss_kb'] = peak_rss_kb()
+
+    # Загрузка той же гифки из библиотеки с готовым .kfr, как при следующем запуске
+    # виджета. Копия в библиотеке — другой путь, так что кэш кадров окна не помогает
+    library_copy = os.path.join(home, 'copy' + os.path.splitext(gif_path)[1])
+    shutil.copy(gif_path, library_copy)
+    library_gif = window.gif_library.add_file(library_copy)
+    result['store_size'] = window.gif_library.store_frames(library_gif)
+    if result['store_size']:
+        start = time.perf_counter()
+        window.gif_player.load(library_gif, window.gif_frame_size())
+        window.gif_player.start()
+        result['store_load_ms'] = (time.perf_counter() - start) * 1000
+    window.close()
+
+    start = time.perf_counter()
+    images, delays = Kiwi_Widget.decode_gif_frames(gif_path)
+    decode_time = time.perf_counter() - start
+    result['frames'] = len(images)
+    result['width'] = images[0].width()
+    result['height'] = images[0].height()
+    result['decode_ms_per_frame'] = decode_time * 1000 / len(images)
+
+    del images
+    if result['store_size']:
+        start = time.perf_counter()
+        stored = Kiwi_Widget.decode_source(library_gif)
+        result['store_decode_ms_per_frame'] = (time.perf_counter() - start) * 1000 / len(stored[0])
+        del stored
+
+    shutil.rmtree(home, ignore_errors=True)
+    return result
+
+
+def compare(old, new):
+    # Печатает относительное изменение числовых метрик по каждому GIF
+    old_cases = {case['gif']: case for case in old.get('cases', [])}
+    for case in new.get('cases', []):
+        before = old_cases.get(case['gif'])
+        if not before:
+            continue
+        print(case['gif'])
+        for key, value in case.items():
+            if isinstance(value, (int, float)) and isinstance(before.get(key), (int, float)) and before[key]:
+                print(f"  {key}: {before[key]:.3f} -> {value:.3f} ({(value / before[key] - 1) * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк Kiwi Widget без экрана")
+    parser.add_argument('--output', help="Куда записать JSON (по умолчанию stdout)")
+    parser.add_argument('--compare', help="JSON прошлого запуска для сравнения")
+    parser.add_argument('--gif', action='append', help="Свой GIF вместо сгенерированных (можно несколько)")
+    parser.add_argument('--resize-deltas', type=int, nargs='+', default=DEFAULT_RESIZE_DELTAS)
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.resize_deltas)))
+        return
+
+    workdir = tempfile.mkdtemp(prefix='kiwi_bench_gifs_')
+    gif_paths = args.gif or []
+    if not gif_paths:
+        for width, height, frames in DEFAULT_CASES:
+            path = os.path.join(workdir, f"bench_{width}x{height}_{frames}f.gif")
+            write_test_gif(path, width, height, frames)
+            gif_paths.append(path)
+
+    cases = []
+    for gif_path in gif_paths:
+        print(f"Бенчмарк {os.path.basename(gif_path)}...", file=sys.stderr)
+        command = [sys.executable, os.path.abspath(__file__), '--case', gif_path,
+                   '--resize-deltas', *map(str, args.resize_deltas)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        cases.append(json.loads(output.strip().splitlines()[-1]))
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'version': 1,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'cases': cases,
+    }
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
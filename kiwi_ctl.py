@@ -0,0 +1,82 @@
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# Легкий клиент команд для запущенного Kiwi Widget: не импортирует Qt, поэтому
+# команда занимает миллисекунды, а не запуск целого процесса.
+#
+#   python kiwi_ctl.py set-gif https://example.com/cat.gif
+#   python kiwi_ctl.py resize 400 300 --widget 1
+#   python kiwi_ctl.py query-stats
+
+# Должно совпадать с IPC_SERVER_NAME и ipc_address() в Kiwi_Widget.py
+DOCUMENTS_DIR = os.path.join(os.path.expanduser("~"), "Documents", "Kiwi Widget")
+IPC_SERVER_NAME = 'kiwi-widget-' + hashlib.sha1(DOCUMENTS_DIR.encode('utf-8')).hexdigest()[:12]
+
+
+def request(command, args, widget, timeout):
+    line = (json.dumps({'command': command, 'args': args, 'widget': widget}, ensure_ascii=False) + '\n').encode('utf-8')
+    if sys.platform == 'win32':
+        # QLocalServer на Windows — именованный канал
+        with open('\\\\.\\pipe\\' + IPC_SERVER_NAME, 'r+b', buffering=0) as pipe:
+            pipe.write(line)
+            reply = b''
+            while not reply.endswith(b'\n'):
+                chunk = pipe.read(4096)
+                if not chunk:
+                    break
+                reply += chunk
+    else:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(os.path.join(tempfile.gettempdir(), IPC_SERVER_NAME))
+            sock.sendall(line)
+            reply = b''
+            while not reply.endswith(b'\n'):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                reply += chunk
+    return json.loads(reply.decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Управление запущенным Kiwi Widget")
+    parser.add_argument('--widget', type=int, default=0, help="Номер виджета (по умолчанию 0)")
+    parser.add_argument('--timeout', type=float, default=2.0, help="Таймаут ответа в секундах")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('set-gif', help="Показать файл или ссылку").add_argument('source')
+    resize = commands.add_parser('resize', help="Изменить размер")
+    resize.add_argument('width', type=int)
+    resize.add_argument('height', type=int)
+    move = commands.add_parser('move', help="Переместить")
+    move.add_argument('x', type=int)
+    move.add_argument('y', type=int)
+    commands.add_parser('opacity', help="Прозрачность 30-100").add_argument('value', type=int)
+    commands.add_parser('pause', help="Поставить на паузу")
+    commands.add_parser('resume', help="Снять с паузы")
+    commands.add_parser('next', help="Следующая гифка плейлиста")
+    commands.add_parser('show', help="Показать окна")
+    commands.add_parser('restart', help="Мягкий перезапуск без нового процесса")
+    commands.add_parser('query-stats', help="Состояние виджетов и память")
+    import_parser = commands.add_parser('import', help="Импорт папки или архива (zip, tar) в библиотеку")
+    import_parser.add_argument('source', type=os.path.abspath)
+    import_parser.add_argument('--transcode', action='store_true', help="Сразу подготовить .kfr для быстрой загрузки")
+    args = parser.parse_args()
+
+    command_args = [value for key, value in vars(args).items() if key not in ('widget', 'timeout', 'command')]
+    try:
+        reply = request(args.command, command_args, args.widget, args.timeout)
+    except (OSError, ValueError) as e:
+        print(f"Kiwi Widget не запущен или не отвечает: {e}", file=sys.stderr)
+        sys.exit(2)
+    print(json.dumps(reply, ensure_ascii=False, indent=1))
+    sys.exit(0 if reply.get('ok') else 1)
+
+
+if __name__ == '__main__':
+    main()
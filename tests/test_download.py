@@ -0,0 +1,127 @@
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+
+pytest.importorskip('PyQt5')
+pytest.importorskip('requests')
+
+import benchmark
+import Kiwi_Widget
+
+
+class GifHandler(http.server.BaseHTTPRequestHandler):
+    # Отдает server.files с ETag, условными запросами и Range; каждый запрос пишет в server.log
+    def do_GET(self):
+        body = self.server.files.get(self.path)
+        entry = {'path': self.path, 'range': self.headers.get('Range'),
+                 'if_none_match': self.headers.get('If-None-Match')}
+        self.server.log.append(entry)
+        if body is None:
+            entry['status'] = 404
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if entry['if_none_match'] == etag:
+            entry['status'] = 304
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        start = int(entry['range'][len('bytes='):].rstrip('-')) if entry['range'] else 0
+        entry['status'] = 206 if entry['range'] else 200
+        self.send_response(entry['status'])
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        if entry['range']:
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), GifHandler)
+    httpd.files = {}
+    httpd.log = []
+    httpd.url = lambda path: f'http://127.0.0.1:{httpd.server_port}{path}'
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    # Своя папка библиотеки и свой кэш валидаторов HTTP вместо ~/Documents
+    folder = tmp_path / 'gif_files'
+    folder.mkdir()
+    monkeypatch.setattr(Kiwi_Widget, 'GIF_FOLDER', str(folder))
+    monkeypatch.setattr(Kiwi_Widget, '_http_client', Kiwi_Widget.HttpClient(str(tmp_path / 'http_cache.json')))
+    return Kiwi_Widget.GifLibrary(folder=str(folder), index_path=str(folder / 'library.json'))
+
+
+@pytest.fixture
+def gif_bytes(tmp_path):
+    path = tmp_path / 'test.gif'
+    benchmark.write_test_gif(str(path), 64, 48, 4)
+    return path.read_bytes()
+
+
+def test_resumes_partial_download_with_range(server, library, gif_bytes):
+    server.files['/a.gif'] = gif_bytes
+    url = server.url('/a.gif')
+    part_path = Kiwi_Widget.partial_download_path(url)
+    with open(part_path, 'wb') as f:
+        f.write(gif_bytes[:1000])  # Обрыв прошлой загрузки
+
+    gif_path = Kiwi_Widget.download_to_library(url, library)
+
+    assert server.log[-1]['range'] == 'bytes=1000-'
+    assert server.log[-1]['status'] == 206
+    with open(gif_path, 'rb') as f:
+        assert f.read() == gif_bytes
+    assert not os.path.exists(part_path)
+
+
+def test_revalidates_cached_url_with_304(server, library, gif_bytes):
+    server.files['/a.gif'] = gif_bytes
+    url = server.url('/a.gif')
+    first = Kiwi_Widget.download_to_library(url, library)
+
+    second = Kiwi_Widget.download_to_library(url, library)
+
+    assert second == first
+    assert [entry['status'] for entry in server.log] == [200, 304]
+    assert server.log[-1]['if_none_match'] is not None
+    assert not os.path.exists(Kiwi_Widget.partial_download_path(url))
+
+
+def test_serves_library_copy_when_offline(server, library, gif_bytes):
+    server.files['/a.gif'] = gif_bytes
+    url = server.url('/a.gif')
+    cached = Kiwi_Widget.download_to_library(url, library)
+    server.shutdown()
+    server.server_close()
+
+    assert Kiwi_Widget.download_to_library(url, library) == cached
+    assert Kiwi_Widget.http_client().is_offline()
+    # Пока сеть считается недоступной, сервер даже не спрашиваем
+    assert Kiwi_Widget.download_to_library(url, library) == cached
+    assert len(server.log) == 1
+
+
+def test_rejects_non_gif(server, library):
+    server.files['/page'] = b'<html><body>not a gif</body></html>'
+    url = server.url('/page')
+
+    with pytest.raises(ValueError):
+        Kiwi_Widget.download_to_library(url, library)
+
+    assert library.entries == {}
+    assert not os.path.exists(Kiwi_Widget.partial_download_path(url))